@@ -1,25 +1,78 @@
-from flask import Flask, render_template, request, jsonify, send_from_directory
-import requests
+from flask import Flask, render_template, request, jsonify, send_from_directory, Response
 import json
+import math
 import os
-import base64
 import time
-from werkzeug.utils import secure_filename
-import uuid
-from datetime import datetime
-from PIL import Image, ImageOps
+from werkzeug.exceptions import RequestEntityTooLarge
 import io
 import socket
 import threading
 import subprocess
 import re
+import logging
+import asyncio
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import upstream
+from gateway import GatewayError, GatewayTimeout
+from circuit_breaker import CircuitOpenError
+from task_tracker import TaskTracker, TERMINAL_STATUSES
+from status_cache import StatusCache
+from task_journal import TaskJournal
+from job_queue import JobQueue, QueueFullError
+from image_pipeline import preprocess_image, MIN_EDGE, MAX_EDGE, MAX_BYTES
+from image_pool import ImagePool
+from previews import PreviewStore, PREVIEW_WIDTHS, PREVIEW_FORMATS
+from upload_parser import parse_upload, UploadRejected
+from result_cache import ResultCache, make_key
+from result_store import ResultStore
+from upload_store import UploadStore
+from image_handles import HandleCache, HandleUnavailable, make_handle, parse_handle
+from batch_tracker import BatchTracker
+from key_pool import KeyPool, NoKeyAvailableError
+from qwen_api import generation_payload, edit_payload, task_result, edit_result_url
+import metrics
+from structured_logging import configure_logging, log_event
 
 app = Flask(__name__)
-app.config['UPLOAD_FOLDER'] = 'uploads'
+app.config['UPLOAD_FOLDER'] = os.environ.get('UPLOAD_FOLDER', 'uploads')
+app.config['RESULTS_FOLDER'] = os.environ.get('RESULTS_FOLDER', 'results')
+app.config['MIRROR_RESULTS'] = os.environ.get('MIRROR_RESULTS', '1') == '1'  # serve results from local copies
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
+app.config['EDIT_CONCURRENCY'] = int(os.environ.get('EDIT_CONCURRENCY', 32))  # concurrent edit API calls (coroutines, not threads)
+app.config['EDIT_QUEUE_SIZE'] = int(os.environ.get('EDIT_QUEUE_SIZE', 128))  # max edits waiting for a worker
+app.config['EDIT_QUEUE_PER_CLIENT'] = int(os.environ.get('EDIT_QUEUE_PER_CLIENT', 16))  # max waiting edits per client (0 = no limit)
+app.config['EDIT_QUEUE_DEADLINE'] = float(os.environ.get('EDIT_QUEUE_DEADLINE', 60))  # seconds an edit may wait for a worker (0 = no limit)
+app.config['EDIT_CLIENT_WEIGHTS'] = os.environ.get('EDIT_CLIENT_WEIGHTS', '')  # "client=weight,...": larger share of edit workers
+app.config['CLIENT_ID_HEADER'] = os.environ.get('CLIENT_ID_HEADER', '')  # e.g. X-Forwarded-For behind a trusted proxy
+app.config['BATCH_CONCURRENCY'] = int(os.environ.get('BATCH_CONCURRENCY', 4))  # concurrent batch task submissions
+app.config['BATCH_MAX_ITEMS'] = int(os.environ.get('BATCH_MAX_ITEMS', 50))
+app.config['KEEP_PREPROCESSED_UPLOADS'] = os.environ.get('KEEP_PREPROCESSED_UPLOADS') == '1'  # debug only
+app.config['IMAGE_POOL_WORKERS'] = int(os.environ.get('IMAGE_POOL_WORKERS', min(4, (os.cpu_count() or 1) // 2)))  # 0: transform in the request thread
+app.config['UPLOAD_MAX_PIXELS'] = int(os.environ.get('UPLOAD_MAX_PIXELS', 64 * 1024 * 1024))  # rejected from the header
+app.config['UPLOAD_QUOTA_BYTES'] = int(os.environ.get('UPLOAD_QUOTA_BYTES', 512 * 1024 * 1024))
+app.config['UPLOAD_MAX_AGE'] = int(os.environ.get('UPLOAD_MAX_AGE', 24 * 3600))  # unused uploads older than this are swept
+app.config['IMAGE_HANDLE_CACHE_BYTES'] = int(os.environ.get('IMAGE_HANDLE_CACHE_BYTES', 128 * 1024 * 1024))  # preprocessed images kept for edit chains
+app.config['RESULT_CACHE_DIR'] = os.environ.get('RESULT_CACHE_DIR', os.path.join('cache', 'results'))
+app.config['RESULT_CACHE_MEMORY_ITEMS'] = int(os.environ.get('RESULT_CACHE_MEMORY_ITEMS', 256))
+app.config['RESULT_CACHE_DISK_BYTES'] = int(os.environ.get('RESULT_CACHE_DISK_BYTES', 64 * 1024 * 1024))
+app.config['RESULT_CACHE_TTL'] = int(os.environ.get('RESULT_CACHE_TTL', 12 * 3600))  # below the result URL lifetime
+app.config['RESULTS_QUOTA_BYTES'] = int(os.environ.get('RESULTS_QUOTA_BYTES', 2 * 1024 * 1024 * 1024))  # mirrored result images
+app.config['RESULTS_MAX_AGE'] = int(os.environ.get('RESULTS_MAX_AGE', 30 * 24 * 3600))  # unused results older than this are deleted
+app.config['PREVIEW_FOLDER'] = os.environ.get('PREVIEW_FOLDER', os.path.join('cache', 'previews'))
+app.config['PREVIEW_CACHE_BYTES'] = int(os.environ.get('PREVIEW_CACHE_BYTES', 256 * 1024 * 1024))
+app.config['TASK_JOURNAL_PATH'] = os.environ.get('TASK_JOURNAL_PATH', 'tasks.db')  # SQLite, shared by all workers
+app.config['TASK_JOURNAL_RETENTION_DAYS'] = int(os.environ.get('TASK_JOURNAL_RETENTION_DAYS', 30))
+app.config['TASK_JOURNAL_LEASE'] = float(os.environ.get('TASK_JOURNAL_LEASE', 60))  # seconds before an exited process's tasks are taken over
+app.config['TASK_STATUS_TTL'] = float(os.environ.get('TASK_STATUS_TTL', 1.0))  # seconds a PROCESSING status is reused
+app.config['TASK_STATUS_CACHE_SIZE'] = int(os.environ.get('TASK_STATUS_CACHE_SIZE', 10000))
+app.config['SSE_MAX_SECONDS'] = float(os.environ.get('SSE_MAX_SECONDS', 30))  # a status stream holds a server thread; browsers reconnect after this
 
-# Create uploads directory if it doesn't exist
-os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+app.config['LOG_LEVEL'] = os.environ.get('LOG_LEVEL', 'INFO')  # DEBUG for request/response detail, OFF to silence
+app.config['LOG_FORMAT'] = os.environ.get('LOG_FORMAT', 'text')  # text or json
+
+configure_logging(app.config['LOG_LEVEL'], app.config['LOG_FORMAT'])
+logger = logging.getLogger(__name__)
 
 # Load API keys
 def load_api_keys():
@@ -31,66 +84,89 @@ def load_api_keys():
 
 API_KEYS = load_api_keys()
 
+# Every upstream call is scheduled through the key pool (token buckets + 429 sidelining)
+upstream.configure_keys(KeyPool.from_config(API_KEYS))
+
 # Allowed file extensions
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'tiff', 'webp'}
+ALLOWED_FORMATS = {'PNG', 'JPEG', 'MPO', 'GIF', 'BMP', 'TIFF', 'WEBP'}  # as sniffed by Pillow; MPO is a camera JPEG
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def expand_image_to_ratio(image_path, target_ratio, max_dimension):
-    """Expand image to target aspect ratio with white padding and resize to max dimension"""
-    # Parse target ratio
-    ratio_parts = target_ratio.split(':')
-    target_width_ratio = float(ratio_parts[0])
-    target_height_ratio = float(ratio_parts[1])
-    target_aspect = target_width_ratio / target_height_ratio
-    
-    # Open and process image
-    with Image.open(image_path) as img:
-        # Convert to RGB if necessary
-        if img.mode != 'RGB':
-            img = img.convert('RGB')
-        
-        original_width, original_height = img.size
-        original_aspect = original_width / original_height
-        
-        # Calculate new dimensions for expansion
-        if original_aspect > target_aspect:
-            # Image is wider than target ratio, add padding to height
-            new_width = original_width
-            new_height = int(original_width / target_aspect)
-        else:
-            # Image is taller than target ratio, add padding to width
-            new_height = original_height
-            new_width = int(original_height * target_aspect)
-        
-        # Create new image with white background
-        expanded_img = Image.new('RGB', (new_width, new_height), 'white')
-        
-        # Calculate position to paste original image (center it)
-        paste_x = (new_width - original_width) // 2
-        paste_y = (new_height - original_height) // 2
-        
-        # Paste original image onto white background
-        expanded_img.paste(img, (paste_x, paste_y))
-        
-        # Resize to max dimension while maintaining aspect ratio
-        expanded_img.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS)
-        
-        # Save expanded image
-        expanded_path = image_path.replace('.', '_expanded.')
-        expanded_img.save(expanded_path, 'JPEG', quality=95)
-        
-        return expanded_path
+# Cache of completed results, keyed by model + parameters (+ input image digest)
+result_cache = ResultCache(
+    app.config['RESULT_CACHE_DIR'],
+    memory_items=app.config['RESULT_CACHE_MEMORY_ITEMS'],
+    disk_max_bytes=app.config['RESULT_CACHE_DISK_BYTES'],
+    ttl=app.config['RESULT_CACHE_TTL']
+)
+
+# Local mirror of result images, served by result_file()
+result_store = ResultStore(
+    app.config['RESULTS_FOLDER'],
+    '/results',
+    quota_bytes=app.config['RESULTS_QUOTA_BYTES'],
+    max_age=app.config['RESULTS_MAX_AGE']
+)
+
+# Deduplicated edit uploads, served by uploaded_file(); creates the uploads directory
+upload_store = UploadStore(
+    app.config['UPLOAD_FOLDER'],
+    '/uploads',
+    max_bytes=app.config['UPLOAD_QUOTA_BYTES'],
+    max_age=app.config['UPLOAD_MAX_AGE']
+)
+
+# Worker processes for decode/resize/encode of uploads; spawned on first use
+image_pool = ImagePool(app.config['IMAGE_POOL_WORKERS']) if app.config['IMAGE_POOL_WORKERS'] > 0 else None
+
+# Small WebP/JPEG versions of uploads and results for preview panes, served by preview_file()
+preview_store = PreviewStore(app.config['PREVIEW_FOLDER'], max_bytes=app.config['PREVIEW_CACHE_BYTES'], pool=image_pool)
+
+def localize_result_url(image_url):
+    """Replace an expiring DashScope result URL with a stable local one"""
+    if not app.config['MIRROR_RESULTS']:
+        return image_url
+    return result_store.mirror_or_original(image_url)
+
+# Cache keys of submitted generation tasks, stored once the task completes
+pending_cache_keys = {}
+
+# Every generation task, so results survive restarts and closed tabs
+task_journal = TaskJournal(
+    app.config['TASK_JOURNAL_PATH'],
+    retention=app.config['TASK_JOURNAL_RETENTION_DAYS'] * 24 * 3600,
+    lease=app.config['TASK_JOURNAL_LEASE']
+)
+
+def journal_submission(task_id, payload, cache_key, state=None):
+    """Record a submitted task; a journal failure must not fail the request"""
+    try:
+        task_journal.record_submission(
+            task_id,
+            payload['input']['prompt'],
+            {**payload['parameters'], 'negative_prompt': payload['input'].get('negative_prompt', '')},
+            cache_key,
+            state,
+            api_key_id=upstream.task_owner_id(task_id)
+        )
+    except sqlite3.Error as e:
+        log_event(logger, logging.ERROR, 'task_journal_failed', task_id=task_id, error=str(e))
 
-def encode_image_to_base64(file_path):
-    """Convert image file to base64 encoding"""
-    with open(file_path, "rb") as image_file:
-        encoded_string = base64.b64encode(image_file.read()).decode('utf-8')
-        # Get file extension to determine MIME type
-        ext = file_path.split('.')[-1].lower()
-        mime_type = f"image/{ext}" if ext != 'jpg' else "image/jpeg"
-        return f"data:{mime_type};base64,{encoded_string}"
+def track_claimed_tasks(claimed):
+    """Track tasks taken over from a process that has exited (e.g. before a restart)"""
+    for task_id, cache_key, api_key_id in claimed:
+        if cache_key:
+            pending_cache_keys[task_id] = cache_key
+        if api_key_id and not upstream.restore_task_owner(task_id, api_key_id):
+            log_event(logger, logging.WARNING, 'task_owner_key_missing', task_id=task_id)
+        task_tracker.track(task_id)
+    log_event(logger, logging.INFO, 'tasks_resumed', count=len(claimed))
+
+def resume_pending_tasks():
+    """Keep this process's task leases alive and resume tasks whose owner has exited"""
+    task_journal.start_heartbeat(track_claimed_tasks)
 
 @app.route('/')
 def index():
@@ -104,298 +180,750 @@ def generate_page():
 def edit_page():
     return render_template('edit.html')
 
+def submit_generation(data):
+    """Submit one text-to-image request; returns (response body, HTTP status)"""
+    payload, error = generation_payload(data)
+    if error:
+        return {'error': error}, 400
+    no_cache = data.get('no_cache', False)
+    
+    # API request headers
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    
+    # Serve repeats of an identical request from the result cache
+    cache_key = make_key(payload['model'], {**payload['input'], **payload['parameters']})
+    if not no_cache:
+        cached = result_cache.get(cache_key)
+        # A mirrored image may have been evicted since; generate it again then
+        if cached and all(result_store.available(url) for url in cached.get('image_urls', [cached['image_url']])):
+            return {
+                'success': True,
+                'status': 'completed',
+                'image_url': cached['image_url'],
+                'image_urls': cached.get('image_urls', [cached['image_url']]),
+                'cached': True
+            }, 200
+    
+    # Add async header for proper API call
+    headers['X-DashScope-Async'] = 'enable'
+    
+    # Step 1: Create task
+    response = upstream.post('image-synthesis', headers, payload)
+    
+    if response.status_code != 200:
+        return {'error': f'API请求失败: {response.text}'}, 500
+    
+    result = response.json()
+    
+    status, urls, _ = task_result(result)
+    if status == 'completed':
+        # Synchronous response
+        image_urls = [localize_result_url(url) for url in urls]
+        result_cache.set(cache_key, {'image_url': image_urls[0], 'image_urls': image_urls})
+        body = {
+            'success': True,
+            'status': 'completed',
+            'image_url': image_urls[0],
+            'image_urls': image_urls,
+            'task_id': result.get('output', {}).get('task_id')
+        }
+        if body['task_id']:
+            journal_submission(body['task_id'], payload, cache_key, body)
+        return body, 200
+    elif result.get('output', {}).get('task_id'):
+        # Asynchronous response - the task tracker polls for results
+        task_id = result['output']['task_id']
+        pending_cache_keys[task_id] = cache_key
+        journal_submission(task_id, payload, cache_key)
+        task_tracker.track(task_id)
+        return {
+            'success': True,
+            'task_id': task_id,
+            'status': 'processing'
+        }, 200
+    else:
+        return {'error': '图像生成失败'}, 500
+
 @app.route('/generate-image', methods=['POST'])
 def generate_image():
     """Generate image using Qwen Image Generation API"""
+    try:
+        body, status = submit_generation(request.get_json())
+        return jsonify(body), status
+    
+    except (CircuitOpenError, NoKeyAvailableError) as e:
+        return busy_response(str(e), e.retry_after)
+    except Exception as e:
+        return jsonify({'error': f'服务器错误: {str(e)}'}), 500
+
+def run_batch_item(batch_id, index, item):
+    """Submit one batch item and attach its task to the batch"""
+    try:
+        body, _ = submit_generation(item)
+    except Exception as e:
+        body = {'error': f'服务器错误: {str(e)}'}
+    
+    if 'error' in body:
+        batch_tracker.update_item(batch_id, index, {'success': False, 'status': 'failed', 'error': body['error']})
+        return
+    
+    batch_tracker.update_item(batch_id, index, body)
+    if body['status'] == 'processing':
+        # The task may have finished before the batch started listening for it
+        state = task_tracker.get(body['task_id'])
+        if state and state['status'] in TERMINAL_STATUSES:
+            batch_tracker.task_changed(body['task_id'], state)
+
+batch_tracker = BatchTracker()
+batch_executor = ThreadPoolExecutor(max_workers=app.config['BATCH_CONCURRENCY'], thread_name_prefix='batch-submit')
+
+@app.route('/generate-batch', methods=['POST'])
+def generate_batch():
+    """Fan out a list of generation requests and track them as one batch"""
     try:
         data = request.get_json()
-        prompt = data.get('prompt', '')
         
-        if not prompt:
-            return jsonify({'error': '请输入图像描述'}), 400
+        # Either explicit items or a plain list of prompts; top-level fields are shared defaults
+        defaults = {k: v for k, v in data.items() if k not in ('items', 'prompts')}
+        items = data.get('items') or [{'prompt': p} for p in data.get('prompts', [])]
+        items = [{**defaults, **item} for item in items if item.get('prompt', '').strip()]
         
-        # API request headers
-        headers = {
-            'Content-Type': 'application/json',
-            'Authorization': f'Bearer {API_KEYS.get("qwen-api-key", "")}'
-        }
-        
-        # Get additional parameters
-        negative_prompt = data.get('negative_prompt', '')
-        size = data.get('size', '1328*1328')
-        prompt_extend = data.get('prompt_extend', True)
-        watermark = data.get('watermark', False)
+        if not items:
+            return jsonify({'error': '请输入至少一条图像描述'}), 400
         
-        # API request payload
-        payload = {
-            "model": "qwen-image",
-            "input": {
-                "prompt": prompt
-            },
-            "parameters": {
-                "size": size,
-                "n": 1,
-                "prompt_extend": prompt_extend,
-                "watermark": watermark
-            }
-        }
+        if len(items) > app.config['BATCH_MAX_ITEMS']:
+            return jsonify({'error': f"单次批量最多 {app.config['BATCH_MAX_ITEMS']} 条"}), 400
         
-        # Add negative prompt if provided
-        if negative_prompt:
-            payload["input"]["negative_prompt"] = negative_prompt
+        # Reject bad parameters up front rather than failing every item
+        for item in items:
+            _, error = generation_payload(item)
+            if error:
+                return jsonify({'error': error}), 400
         
-        # Add async header for proper API call
-        headers['X-DashScope-Async'] = 'enable'
+        batch_id = batch_tracker.create(items)
+        for index, item in enumerate(items):
+            batch_executor.submit(run_batch_item, batch_id, index, item)
         
-        # Step 1: Create task
-        response = requests.post(
-            'https://dashscope.aliyuncs.com/api/v1/services/aigc/text2image/image-synthesis',
-            headers=headers,
-            json=payload
-        )
-        
-        if response.status_code != 200:
-            return jsonify({'error': f'API请求失败: {response.text}'}), 500
-        
-        result = response.json()
-        
-        if result.get('output', {}).get('task_status') == 'SUCCEEDED':
-            # Synchronous response
-            image_url = result['output']['results'][0]['url']
-            return jsonify({
-                'success': True,
-                'image_url': image_url,
-                'task_id': result.get('output', {}).get('task_id')
-            })
-        elif result.get('output', {}).get('task_id'):
-            # Asynchronous response - need to poll for results
-            task_id = result['output']['task_id']
-            return jsonify({
-                'success': True,
-                'task_id': task_id,
-                'status': 'processing'
-            })
-        else:
-            return jsonify({'error': '图像生成失败'}), 500
+        return jsonify({
+            'success': True,
+            'batch_id': batch_id,
+            'total': len(items),
+            'status': 'processing'
+        })
             
     except Exception as e:
         return jsonify({'error': f'服务器错误: {str(e)}'}), 500
 
+@app.route('/batches/<batch_id>')
+def batch_status(batch_id):
+    """Current state of every item in a batch"""
+    state = batch_tracker.get(batch_id)
+    if state is None:
+        return jsonify({'success': False, 'status': 'failed', 'error': '批量任务不存在或已过期'}), 404
+    return jsonify(state)
+
+@app.route('/batches/<batch_id>/events')
+def batch_events(batch_id):
+    """Stream batch progress as Server-Sent Events, one event per finished item"""
+    return event_stream_response(batch_tracker.wait, batch_id)
+
+async def fetch_task_status(task_id):
+    """Query DashScope for a task and return its client-facing state"""
+    response = await upstream.get_async('task', {}, task_id=task_id)
+    
+    if response.status_code != 200:
+        raise Exception('任务查询失败')
+    
+    status, urls, error = task_result(response.json())
+    
+    if status == 'completed':
+        # Mirroring blocks on disk and network, so it runs on a helper thread off the loop
+        image_urls = await asyncio.to_thread(lambda: [localize_result_url(url) for url in urls])
+        return {
+            'success': True,
+            'status': 'completed',
+            'image_url': image_urls[0],
+            'image_urls': image_urls
+        }
+    elif status == 'failed':
+        return {
+            'success': False,
+            'status': 'failed',
+            'error': error
+        }
+    else:
+        return {
+            'success': True,
+            'status': 'processing'
+        }
+
+def on_task_change(task_id, state):
+    """Store finished generation results in the journal and result cache, and update batches"""
+    batch_tracker.task_changed(task_id, state)
+    if state['status'] not in TERMINAL_STATUSES:
+        return
+    task_journal.record_state(task_id, state)
+    cache_key = pending_cache_keys.pop(task_id, None)
+    if cache_key and state['status'] == 'completed':
+        result_cache.set(cache_key, {'image_url': state['image_url'], 'image_urls': state['image_urls']})
+
+# Every task query (tracker polls and cold /check-task lookups) goes through the status cache
+status_cache = StatusCache(
+    fetch_task_status,
+    processing_ttl=app.config['TASK_STATUS_TTL'],
+    max_entries=app.config['TASK_STATUS_CACHE_SIZE']
+)
+task_tracker = TaskTracker(status_cache.get, batch_size=64, on_change=on_task_change, gateway=upstream.gateway)
+
 @app.route('/check-task/<task_id>')
 def check_task(task_id):
     """Check the status of an image generation task"""
     try:
-        headers = {
-            'Authorization': f'Bearer {API_KEYS.get("qwen-api-key", "")}'
-        }
-        
-        response = requests.get(
-            f'https://dashscope.aliyuncs.com/api/v1/tasks/{task_id}',
-            headers=headers
+        state = task_tracker.get(task_id)
+        if state is None:
+            # Unknown to this process (e.g. after a restart): one lookup shared by concurrent callers
+            try:
+                state = upstream.gateway.run(status_cache.get(task_id))
+            except Exception as e:
+                log_event(logger, logging.WARNING, 'task_lookup_failed', task_id=task_id, error=str(e))
+            if state is None or state['status'] not in TERMINAL_STATUSES:
+                task_tracker.track(task_id)
+                state = state or task_tracker.get(task_id)
+        return jsonify(state)
+            
+    except Exception as e:
+        return jsonify({'error': f'服务器错误: {str(e)}'}), 500
+
+def event_stream_response(wait, key):
+    """Build an SSE response that relays state changes from a tracker's wait()"""
+    def event_stream():
+        version = -1
+        # Each stream holds a server thread, so it ends after SSE_MAX_SECONDS; the
+        # browser reconnects after `retry` ms and is sent the current state again
+        deadline = time.time() + app.config['SSE_MAX_SECONDS']
+        yield 'retry: 1000\n\n'
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                return
+            new_version, state = wait(key, version, timeout=min(15, remaining))
+            if state is None:
+                return
+            if new_version == version:
+                # Heartbeat keeps proxies from closing an idle stream
+                yield ': keep-alive\n\n'
+                continue
+            version = new_version
+            yield f'data: {json.dumps(state, ensure_ascii=False)}\n\n'
+            if state['status'] in TERMINAL_STATUSES:
+                return
+    
+    return Response(event_stream(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/tasks/stats')
+def task_stats():
+    """Status cache hit/miss/coalescing counters and journaled tasks by status"""
+    return jsonify({**status_cache.stats(), 'journal': task_journal.stats()})
+
+@app.route('/tasks/history')
+def task_history():
+    """Journaled generation tasks, newest first; filter by status, prompt text (q) and time range"""
+    status = request.args.get('status') or None
+    if status not in (None, 'processing') + TERMINAL_STATUSES:
+        return jsonify({'error': '无效的任务状态'}), 400
+    try:
+        items, next_cursor = task_journal.history(
+            status=status,
+            query=request.args.get('q', '').strip() or None,
+            since=request.args.get('since', type=float),
+            until=request.args.get('until', type=float),
+            cursor=request.args.get('cursor') or None,
+            limit=min(max(request.args.get('limit', 20, type=int), 1), 100)
         )
+    except ValueError:
+        return jsonify({'error': '无效的分页游标'}), 400
+    return jsonify({'success': True, 'items': items, 'next_cursor': next_cursor})
+
+@app.route('/tasks/<task_id>/events')
+def task_events(task_id):
+    """Stream task state changes to the browser as Server-Sent Events"""
+    task_tracker.track(task_id)
+    return event_stream_response(task_tracker.wait, task_id)
+
+async def run_edit_job(image, edit_prompt, cache_key=None):
+    """Call the Qwen Image Edit API for a preprocessed image (runs on the job queue)"""
+    # API request headers
+    headers = {
+        'Content-Type': 'application/json'
+    }
+    
+    payload = edit_payload(image, edit_prompt)
+    
+    log_event(logger, logging.INFO, 'edit_upstream_request',
+              prompt_chars=len(edit_prompt), payload_chars=len(image))
+    
+    start_time = time.time()
+    
+    try:
+        response = await upstream.post_async('multimodal-generation', headers, payload)
         
-        if response.status_code != 200:
-            return jsonify({'error': '任务查询失败'}), 500
-        
-        result = response.json()
-        
-        if result.get('output', {}).get('task_status') == 'SUCCEEDED':
-            image_url = result['output']['results'][0]['url']
-            return jsonify({
-                'success': True,
-                'status': 'completed',
-                'image_url': image_url
-            })
-        elif result.get('output', {}).get('task_status') == 'FAILED':
-            return jsonify({
-                'success': False,
-                'status': 'failed',
-                'error': result.get('output', {}).get('message', '任务失败')
-            })
-        else:
-            return jsonify({
-                'success': True,
-                'status': 'processing'
-            })
+        duration = time.time() - start_time
+        log_event(logger, logging.INFO, 'edit_upstream_response',
+                  status=response.status_code, duration=round(duration, 2),
+                  request_id=response.headers.get('X-DashScope-Request-Id', ''))
+        log_event(logger, logging.DEBUG, 'edit_upstream_body', body=response.text[:500])
             
+    except (CircuitOpenError, NoKeyAvailableError) as e:
+        return {'success': False, 'status': 'failed', 'error': str(e), 'retry_after': math.ceil(e.retry_after or 1)}
+    except GatewayTimeout:
+        log_event(logger, logging.WARNING, 'edit_upstream_timeout', duration=round(time.time() - start_time, 2))
+        raise Exception("API请求超时")
+    except GatewayError as e:
+        log_event(logger, logging.WARNING, 'edit_upstream_error', error=str(e))
+        raise
+    
+    if response.status_code != 200:
+        return {'success': False, 'status': 'failed', 'error': f'API请求失败: {response.text}'}
+    
+    result_url = edit_result_url(response.json())
+    if result_url:
+        image_url = await asyncio.to_thread(localize_result_url, result_url)
+        if cache_key:
+            await asyncio.to_thread(result_cache.set, cache_key, {'image_url': image_url})
+        return {
+            'success': True,
+            'status': 'completed',
+            'image_url': image_url
+        }
+    
+    return {'success': False, 'status': 'failed', 'error': '图像编辑失败，未找到结果图像'}
+
+def parse_client_weights(value):
+    """Client -> weight from EDIT_CLIENT_WEIGHTS ("client=weight,client=weight")"""
+    weights = {}
+    for item in value.split(','):
+        client, _, weight = item.strip().rpartition('=')
+        if client:
+            weights[client] = max(1, int(weight))
+    return weights
+
+def client_id():
+    """Who a request comes from, for fair queueing: CLIENT_ID_HEADER (set by a trusted proxy) or the peer address"""
+    header = app.config['CLIENT_ID_HEADER']
+    value = request.headers.get(header, '').split(',')[0].strip() if header else ''
+    return value or request.remote_addr or 'unknown'
+
+def busy_response(message, retry_after=None):
+    """503 with a Retry-After hint when one is known"""
+    if retry_after is None:
+        return jsonify({'error': message}), 503
+    retry_after = max(1, math.ceil(retry_after))
+    return jsonify({'error': message, 'retry_after': retry_after}), 503, {'Retry-After': str(retry_after)}
+
+# Edits may not hold more key slots than the pool sets aside for them,
+# otherwise queued edits would fail waiting for a key instead of waiting in the queue
+edit_capacity = upstream.key_pool.edit_capacity()
+if edit_capacity is not None and app.config['EDIT_CONCURRENCY'] > edit_capacity:
+    log_event(logger, logging.WARNING, 'edit_concurrency_capped',
+              configured=app.config['EDIT_CONCURRENCY'], capacity=edit_capacity)
+    app.config['EDIT_CONCURRENCY'] = edit_capacity
+
+# Edits are started round-robin across clients and shed once they would wait past the deadline
+edit_queue = JobQueue(
+    max_workers=app.config['EDIT_CONCURRENCY'],
+    max_pending=app.config['EDIT_QUEUE_SIZE'],
+    name='edit-job',
+    gateway=upstream.gateway,
+    max_wait=app.config['EDIT_QUEUE_DEADLINE'] or None,
+    max_pending_per_client=app.config['EDIT_QUEUE_PER_CLIENT'] or None,
+    weights=parse_client_weights(app.config['EDIT_CLIENT_WEIGHTS'])
+)
+
+# Prepared edit inputs, so edit chains skip the upload and preprocessing (see image_handles.py)
+def load_image_handle(handle):
+    """Rebuild the edit input a handle names from the stored upload or result image"""
+    kind, name, expansion = parse_handle(handle)
+    if kind == 'job':
+        state = edit_queue.get(name)
+        if state is None:
+            raise HandleUnavailable('任务不存在或已过期')
+        if state['status'] != 'completed':
+            raise HandleUnavailable('任务尚未成功完成', 409)
+        result_name = result_store.filename(state['image_url'])
+        if result_name is None:
+            # Not mirrored locally: DashScope fetches the result URL itself
+            return {'image': state['image_url'], 'digest': state['image_url'], 'expansion': None}
+        kind, name = 'result', result_name
+    
+    path = result_store.path(name) if kind == 'result' else upload_store.path(name)
+    if path is None:
+        raise HandleUnavailable('图像句柄不存在或已过期')
+    with open(path, 'rb') as f:
+        raw = f.read()
+    image, info = preprocess_image(raw, expansion, pool=image_pool)
+    return {
+        'image': image,
+        'digest': name.rsplit('.', 1)[0],  # stored files are named by their SHA-256
+        'expansion': list(expansion) if expansion else None,
+        'upload_name': name if kind == 'upload' else None,
+        'width': info.get('out_width', info['width']),
+        'height': info.get('out_height', info['height'])
+    }
+
+handle_cache = HandleCache(load_image_handle, max_bytes=app.config['IMAGE_HANDLE_CACHE_BYTES'])
+
+def check_upload_header(upload):
+    """Refuse an edit upload from its sniffed header, before the rest of the body arrives"""
+    image_format, width, height = upload.header
+    if not allowed_file(upload.filename or '') or image_format not in ALLOWED_FORMATS:
+        raise UploadRejected('不支持的文件格式')
+    if max(width, height) < MIN_EDGE:
+        # Padding can lengthen the short edge but never beyond the long one
+        raise UploadRejected(f'图像尺寸过小（{width}x{height}），宽高均需至少 {MIN_EDGE} 像素')
+    if width * height > app.config['UPLOAD_MAX_PIXELS']:
+        raise UploadRejected(f'图像分辨率过大（{width}x{height}）', 413)
+
+def receive_image_upload():
+    """Stream-parse the multipart body; returns (upload, None) or (None, error response)"""
+    # Parse the body as it arrives; unusable images are refused from their header
+    try:
+        return parse_upload(request.stream, request.content_type, 'image', on_header=check_upload_header), None
+    except RequestEntityTooLarge:
+        limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+        return None, (jsonify({'error': f'文件过大，最大 {limit_mb}MB'}), 413, {'Connection': 'close'})
+    except UploadRejected as e:
+        log_event(logger, logging.INFO, 'edit_upload_rejected', reason=str(e))
+        # The rest of the body is never read, so the connection cannot be reused
+        return None, (jsonify({'error': str(e)}), e.status, {'Connection': 'close'})
+
+def upload_error(upload):
+    """Error message for a missing or unsupported image file, else None"""
+    if upload is None or upload.filename is None:
+        return '请上传图像文件'
+    if upload.filename == '' or not upload.data:
+        return '请选择图像文件'
+    if not allowed_file(upload.filename):
+        return '不支持的文件格式'
+    return None
+
+def edit_expansion(fields):
+    """(target_ratio, max_dimension) from the form fields, or None if expansion is off"""
+    if fields.get('enable_expansion') != 'true':
+        return None
+    return fields.get('target_ratio', '1:1'), int(fields.get('max_dimension', 1536))
+
+def prepare_upload(upload, expansion):
+    """Preprocess an upload, store the original and cache the result under an image handle.
+
+    Returns (handle, entry). The caller holds one upload_store reference to
+    entry['upload_name'] and must release it.
+    """
+    # Decode, optionally expand and encode entirely in memory
+    debug_store = upload_store if app.config['KEEP_PREPROCESSED_UPLOADS'] else None
+    image, info = preprocess_image(upload.data, expansion, debug_store, pool=image_pool)
+    metrics.PAYLOAD_SIZE.observe(len(image))
+    
+    original_width, original_height = info['width'], info['height']
+    file_size = info['size']
+    log_event(logger, logging.INFO, 'edit_image_preprocessed',
+              width=original_width, height=original_height, bytes=file_size,
+              format=info['format'], mode=info['mode'], expansion=expansion[0] if expansion else None,
+              max_dimension=expansion[1] if expansion else None,
+              out_width=info.get('out_width'), out_height=info.get('out_height'),
+              payload_chars=len(image))
+    
+    out_width, out_height = info.get('out_width', original_width), info.get('out_height', original_height)
+    if out_width < MIN_EDGE or out_height < MIN_EDGE:
+        raise UploadRejected(f'图像尺寸过小（{out_width}x{out_height}），宽高均需至少 {MIN_EDGE} 像素')
+    
+    # Inputs past the API limits were scaled down by preprocess_image
+    if original_width > MAX_EDGE or original_height > MAX_EDGE or file_size > MAX_BYTES:
+        log_event(logger, logging.INFO, 'edit_image_downscaled', width=original_width, height=original_height,
+                  bytes=file_size, decoded_width=info.get('decoded_width'), decoded_height=info.get('decoded_height'))
+    
+    # Keep the original (deduplicated by content); handles are rebuilt from it
+    upload_name = upload_store.put(upload.data, upload.filename.rsplit('.', 1)[1], acquire=True)
+    entry = {
+        'image': image,
+        'digest': upload.digest,
+        'expansion': list(expansion) if expansion else None,
+        'upload_name': upload_name,
+        'width': out_width,
+        'height': out_height
+    }
+    handle = make_handle(upload_name, expansion)
+    handle_cache.put(handle, entry)
+    return handle, entry
+
+@app.route('/images', methods=['POST'])
+def create_image_handle():
+    """Upload and preprocess an image once; returns a handle for /edit-image"""
+    try:
+        upload, error = receive_image_upload()
+        if error:
+            return error
+        message = upload_error(upload)
+        if message:
+            return jsonify({'error': message}), 400
+        try:
+            handle, entry = prepare_upload(upload, edit_expansion(upload.fields))
+        except UploadRejected as e:
+            return jsonify({'error': str(e)}), e.status
+        upload_store.release(entry['upload_name'])
+        return jsonify({
+            'success': True,
+            'image_handle': handle,
+            'width': entry['width'],
+            'height': entry['height'],
+            'upload_url': upload_store.local_url(entry['upload_name'])
+        })
     except Exception as e:
         return jsonify({'error': f'服务器错误: {str(e)}'}), 500
 
+@app.route('/images/stats')
+def image_handle_stats():
+    """Image handle cache hits, misses and memory use"""
+    return jsonify(handle_cache.stats())
+
 @app.route('/edit-image', methods=['POST'])
 def edit_image():
-    """Edit image using Qwen Image Edit API"""
-    print("="*50)
-    print("图像编辑请求开始")
-    print(f"请求方法: {request.method}")
-    print(f"Content-Type: {request.content_type}")
-    print(f"表单数据: {dict(request.form)}")
-    print(f"文件数据: {list(request.files.keys())}")
-    print("="*50)
+    """Validate and preprocess an edit request, then enqueue the API call.
+
+    The image is either uploaded as the `image` file or named by an
+    `image_handle` (from /images, an earlier edit, or "job:<job_id>" for a
+    finished edit's result); handle-only requests may also be sent as JSON.
+    """
+    log_event(logger, logging.DEBUG, 'edit_request',
+              content_type=request.content_type, content_length=request.content_length)
     try:
-        # Check if image file is uploaded
-        if 'image' not in request.files:
-            return jsonify({'error': '请上传图像文件'}), 400
+        if request.mimetype == 'multipart/form-data':
+            upload, error = receive_image_upload()
+            if error:
+                return error
+            fields = upload.fields
+        else:
+            upload = None
+            fields = request.get_json(silent=True) or {}
         
-        file = request.files['image']
-        edit_prompt = request.form.get('edit_prompt', '')
-        enable_expansion = request.form.get('enable_expansion') == 'true'
-        target_ratio = request.form.get('target_ratio', '1:1')
-        max_dimension = int(request.form.get('max_dimension', 1536))
+        edit_prompt = fields.get('edit_prompt', '')
+        handle = fields.get('image_handle', '')
+        no_cache = fields.get('no_cache') in ('true', True)
         
-        if file.filename == '':
-            return jsonify({'error': '请选择图像文件'}), 400
+        if not handle:
+            message = upload_error(upload)
+            if message:
+                return jsonify({'error': message}), 400
         
         if not edit_prompt:
             return jsonify({'error': '请输入编辑指令'}), 400
         
-        if file and allowed_file(file.filename):
-            # Save uploaded file
-            filename = secure_filename(file.filename)
-            unique_filename = f"{uuid.uuid4()}_{filename}"
-            file_path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-            file.save(file_path)
-            
+        if handle:
+            # A handle carries its own expansion; the request's settings do not apply
             try:
-                # Check image dimensions before processing
-                with Image.open(file_path) as img:
-                    original_width, original_height = img.size
-                    file_size = os.path.getsize(file_path)
-                    print(f"原始图像信息:")
-                    print(f"  - 尺寸: {original_width}x{original_height}")
-                    print(f"  - 文件大小: {file_size / (1024*1024):.2f} MB")
-                    print(f"  - 格式: {img.format}")
-                    print(f"  - 模式: {img.mode}")
-                    
-                    # Check API requirements
-                    if original_width < 384 or original_height < 384:
-                        print(f"警告: 图像尺寸过小 ({original_width}x{original_height})，API要求最小384像素")
-                    if original_width > 3072 or original_height > 3072:
-                        print(f"警告: 图像尺寸过大 ({original_width}x{original_height})，API要求最大3072像素")
-                    if file_size > 10 * 1024 * 1024:
-                        print(f"警告: 文件大小过大 ({file_size / (1024*1024):.2f} MB)，API要求最大10MB")
-                
-                # Apply image expansion if enabled
-                if enable_expansion:
-                    print(f"启用智能扩图: {target_ratio}, 最大尺寸: {max_dimension}")
-                    file_path = expand_image_to_ratio(file_path, target_ratio, max_dimension)
-                    
-                    # Check expanded image dimensions
-                    with Image.open(file_path) as expanded_img:
-                        exp_width, exp_height = expanded_img.size
-                        exp_file_size = os.path.getsize(file_path)
-                        print(f"扩图后图像信息:")
-                        print(f"  - 尺寸: {exp_width}x{exp_height}")
-                        print(f"  - 文件大小: {exp_file_size / (1024*1024):.2f} MB")
-                
-                # Convert image to base64
-                print("开始转换图像为Base64...")
-                image_base64 = encode_image_to_base64(file_path)
-                print(f"Base64编码完成，长度: {len(image_base64)} 字符")
-                
-                # API request headers
-                headers = {
-                    'Content-Type': 'application/json',
-                    'Authorization': f'Bearer {API_KEYS.get("qwen-api-key", "")}'
-                }
-                
-                # API request payload
-                payload = {
-                    "model": "qwen-image-edit",
-                    "input": {
-                        "messages": [
-                            {
-                                "role": "user",
-                                "content": [
-                                    {
-                                        "image": image_base64
-                                    },
-                                    {
-                                        "text": edit_prompt
-                                    }
-                                ]
-                            }
-                        ]
-                    },
-                    "parameters": {
-                        "negative_prompt": "",
-                        "watermark": False
-                    }
-                }
-                
-                print(f"=== 发送API请求 ===")
-                print(f"URL: https://dashscope.aliyuncs.com/api/v1/services/aigc/multimodal-generation/generation")
-                print(f"编辑指令: {edit_prompt}")
-                print(f"API Key: {API_KEYS.get('qwen-api-key', 'NOT_FOUND')[:20]}...")
-                print(f"Base64图像长度: {len(image_base64)} 字符")
-                print(f"请求参数: enable_expansion={enable_expansion}, target_ratio={target_ratio}, max_dimension={max_dimension}")
-                
-                start_time = time.time()
-                print(f"开始时间: {datetime.now().strftime('%H:%M:%S')}")
-                
-                try:
-                    response = requests.post(
-                        'https://dashscope.aliyuncs.com/api/v1/services/aigc/multimodal-generation/generation',
-                        headers=headers,
-                        json=payload,
-                        timeout=60
-                    )
-                    
-                    end_time = time.time()
-                    duration = end_time - start_time
-                    print(f"=== API响应 ===")
-                    print(f"响应时间: {duration:.2f}秒")
-                    print(f"状态码: {response.status_code}")
-                    print(f"响应头: {dict(response.headers)}")
-                    
-                    if response.status_code == 200:
-                        print(f"响应内容: {response.text[:1000]}...")
-                    else:
-                        print(f"错误响应: {response.text}")
-                        
-                except requests.exceptions.Timeout:
-                    print("请求超时 (60秒)")
-                    raise Exception("API请求超时")
-                except requests.exceptions.RequestException as e:
-                    print(f"请求异常: {str(e)}")
-                    raise
-                
-                # Clean up uploaded file
-                os.remove(file_path)
-                
-                if response.status_code != 200:
-                    return jsonify({'error': f'API请求失败: {response.text}'}), 500
-                
-                result = response.json()
-                
-                if result.get('output', {}).get('choices'):
-                    # Extract image URL from response
-                    choice = result['output']['choices'][0]
-                    if 'message' in choice and 'content' in choice['message']:
-                        content = choice['message']['content']
-                        if isinstance(content, list):
-                            for item in content:
-                                if isinstance(item, dict) and 'image' in item:
-                                    return jsonify({
-                                        'success': True,
-                                        'image_url': item['image']
-                                    })
-                
-                return jsonify({'error': '图像编辑失败，未找到结果图像'}), 500
-                
-            except Exception as e:
-                # Clean up uploaded file in case of error
-                if os.path.exists(file_path):
-                    os.remove(file_path)
-                raise e
+                entry = handle_cache.get(handle)
+            except HandleUnavailable as e:
+                return jsonify({'error': str(e)}), e.status
+            expansion, digest = entry['expansion'], entry['digest']
         else:
-            return jsonify({'error': '不支持的文件格式'}), 400
+            expansion, digest = edit_expansion(fields), upload.digest
+        
+        # Serve repeats of the same edit on the same image from the result cache
+        cache_key = make_key('qwen-image-edit', {
+            'prompt': edit_prompt,
+            'expansion': list(expansion) if expansion else None,
+            'negative_prompt': '',
+            'watermark': False
+        }, digest)
+        if not no_cache:
+            cached = result_cache.get(cache_key)
+            if cached and result_store.available(cached['image_url']):
+                return jsonify({
+                    'success': True,
+                    'status': 'completed',
+                    'image_url': cached['image_url'],
+                    'cached': True
+                })
+        
+        # Fail fast while the edit API is known to be down, rather than queueing doomed jobs
+        retry_after = upstream.circuit_retry_after('multimodal-generation')
+        if retry_after is not None:
+            return busy_response(str(CircuitOpenError(retry_after)), retry_after)
+        
+        if handle:
+            upload_name = entry.get('upload_name')
+            if upload_name and not upload_store.acquire(upload_name):
+                upload_name = None
+        else:
+            try:
+                handle, entry = prepare_upload(upload, expansion)
+            except UploadRejected as e:
+                return jsonify({'error': str(e)}), e.status
+            upload_name = entry['upload_name']
+        
+        def release_upload(state):
+            if upload_name:
+                upload_store.release(upload_name)
+        
+        # Hand the slow API call to the edit worker pool
+        try:
+            job_id = edit_queue.submit(run_edit_job, entry['image'], edit_prompt, cache_key, client=client_id())
+        except QueueFullError as e:
+            release_upload(None)
+            return busy_response(str(e), e.retry_after)
+        edit_queue.add_done_callback(job_id, release_upload)
+        
+        response = {
+            'success': True,
+            'job_id': job_id,
+            'status': 'queued',
+            'image_handle': handle
+        }
+        if upload_name:
+            response['upload_url'] = upload_store.local_url(upload_name)
+        return jsonify(response)
             
     except Exception as e:
         return jsonify({'error': f'服务器错误: {str(e)}'}), 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus-format metrics"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/jobs/stats')
+def job_stats():
+    """Edit queue depth, wait-time and load-shedding statistics, and upstream circuit states"""
+    return jsonify({**edit_queue.stats(), 'circuits': upstream.circuit_stats()})
+
+@app.route('/upstream/stats')
+def upstream_stats():
+    """API key load and throttling, gateway connections, circuit states and result cache counters"""
+    return jsonify({
+        'keys': upstream.key_pool.stats(),
+        'gateway': upstream.gateway.stats(),
+        'circuits': upstream.circuit_stats(),
+        'result_cache': result_cache.stats()
+    })
+
+@app.route('/jobs/<job_id>')
+def job_status(job_id):
+    """Check the status/result of a queued edit job"""
+    state = edit_queue.get(job_id)
+    if state is None:
+        return jsonify({'success': False, 'status': 'failed', 'error': '任务不存在或已过期'}), 404
+    return jsonify(state)
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """Cancel an edit job whose client went away; aborts the in-flight upstream call"""
+    if not edit_queue.cancel(job_id):
+        state = edit_queue.get(job_id)
+        if state is None:
+            return jsonify({'success': False, 'status': 'failed', 'error': '任务不存在或已过期'}), 404
+        return jsonify(state), 409
+    return jsonify({'success': True, 'status': 'cancelling'})
+
+@app.route('/jobs/<job_id>/events')
+def job_events(job_id):
+    """Stream edit job state changes as Server-Sent Events"""
+    return event_stream_response(edit_queue.wait, job_id)
+
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    """Serve a stored upload; names are content hashes, so it never changes"""
+    if upload_store.path(filename) is None:
+        return jsonify({'error': '文件不存在或已过期'}), 404
+    response = send_from_directory(
+        app.config['UPLOAD_FOLDER'],
+        filename,
+        etag=filename.rsplit('.', 1)[0],
+        max_age=365 * 24 * 3600,
+        conditional=True
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/previews/<kind>/<filename>/<int:width>.<fmt>')
+def preview_file(kind, filename, width, fmt):
+    """Serve a downscaled preview of an upload or result, rendering it on first request"""
+    stores = {'uploads': upload_store, 'results': result_store}
+    if kind not in stores or width not in PREVIEW_WIDTHS or fmt not in PREVIEW_FORMATS:
+        return jsonify({'error': '不支持的预览规格'}), 404
+    source_path = stores[kind].path(filename)
+    if source_path is None:
+        return jsonify({'error': '文件不存在或已过期'}), 404
+    try:
+        preview_path = preview_store.get(source_path, filename, width, fmt)
+    except Exception as e:
+        log_event(logger, logging.WARNING, 'preview_failed', source=filename, width=width, error=str(e))
+        return jsonify({'error': '预览生成失败'}), 500
+    response = send_from_directory(
+        preview_store.directory,
+        os.path.basename(preview_path),
+        mimetype=PREVIEW_FORMATS[fmt][1],
+        etag=f"{filename.rsplit('.', 1)[0]}_{width}",
+        max_age=365 * 24 * 3600,
+        conditional=True
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+@app.route('/previews/stats')
+def preview_stats():
+    """Preview cache hits, renders and coalesced requests"""
+    return jsonify(preview_store.stats())
+
+@app.route('/uploads/stats')
+def upload_stats():
+    """Upload store size, quota and in-use counts"""
+    return jsonify(upload_store.stats())
+
+@app.route('/results/<filename>')
+def result_file(filename):
+    """Serve a mirrored result image; names are content hashes, so it never changes"""
+    if result_store.path(filename) is None:
+        return jsonify({'error': '文件不存在或已过期'}), 404
+    digest = filename.rsplit('.', 1)[0]
+    response = send_from_directory(
+        app.config['RESULTS_FOLDER'],
+        filename,
+        etag=digest,
+        max_age=365 * 24 * 3600,
+        conditional=True
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+def init_worker():
+    """Per-process initialization for pre-forking servers (see serve.py).
+
+    Connection pools and logging handlers must not be shared across a fork,
+    so each worker builds its own. Trackers, executors and the upstream
+    gateway's event loop start their threads lazily, on first use inside
+    the worker.
+    """
+    upstream.session = upstream.create_session()
+    configure_logging(app.config['LOG_LEVEL'], app.config['LOG_FORMAT'])
+    log_event(logger, logging.INFO, 'worker_started', pid=os.getpid())
+    resume_pending_tasks()
+
+def shutdown_worker():
+    """Graceful per-process shutdown: drop queued work, let running calls finish"""
+    edit_queue.shutdown()
+    batch_executor.shutdown(wait=False, cancel_futures=True)
+    preview_store.executor.shutdown(wait=False, cancel_futures=True)
+    if image_pool is not None:
+        image_pool.shutdown(wait=False)
+    upstream.session.close()
+    log_event(logger, logging.INFO, 'worker_stopped', pid=os.getpid())
 
 def get_all_local_ips():
     """Get all local IP addresses"""
@@ -556,7 +1084,12 @@ if __name__ == '__main__':
     print("="*60)
     
     try:
-        # Run the app accessible from network
-        app.run(host='0.0.0.0', port=5004, debug=True)
+        # Development server; use serve.py for production. The debugger and
+        # reloader are opt-in (FLASK_DEBUG=1) so startup is a single process.
+        debug = os.environ.get('FLASK_DEBUG') == '1'
+        if not debug or os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+            # With the reloader, only the child process that serves requests tracks tasks
+            resume_pending_tasks()
+        app.run(host='0.0.0.0', port=5004, debug=debug, use_reloader=debug, threaded=True)
     except KeyboardInterrupt:
         print("\n👋 服务已停止")
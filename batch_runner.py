@@ -0,0 +1,387 @@
+"""Offline batch runner: execute a JSONL file of generation and edit jobs.
+
+Each line is one job. Generation jobs take the /generate-image fields,
+edit jobs name a local image (relative to the JSONL file) and an edit
+instruction; `id` is optional and defaults to a hash of the line:
+
+    {"id": "cat", "prompt": "一只橘猫", "size": "1328*1328", "negative_prompt": "模糊", "n": 2}
+    {"image": "photos/room.jpg", "edit_prompt": "把墙刷成蓝色", "target_ratio": "16:9", "max_dimension": 1536}
+
+Result images are written to the output directory as <id>.<ext> (or
+<id>_<n>.<ext> for several images) as jobs finish. Every submission and
+outcome is appended to <output>/checkpoint.jsonl, so running the same
+command again skips completed jobs, polls generation tasks that were
+already submitted instead of submitting them again, and retries failed
+jobs. --rate limits submissions per second; task polls and downloads are
+not counted against it.
+
+    python batch_runner.py jobs.jsonl --output out --concurrency 4 --rate 2
+    DASHSCOPE_BASE_URL=http://127.0.0.1:8900 python batch_runner.py jobs.jsonl --output out
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import time
+import uuid
+import upstream
+from circuit_breaker import CircuitOpenError
+from gateway import GatewayError
+from image_pipeline import preprocess_image, MIN_EDGE
+from key_pool import KeyPool, NoKeyAvailableError
+from qwen_api import generation_payload, edit_payload, task_result, edit_result_url
+from result_store import CONTENT_TYPE_EXTENSIONS
+
+# DashScope keeps task results for 24 hours; older submissions are resubmitted
+TASK_RESULT_TTL = 24 * 3600
+
+# Types of the job fields this runner reads; lines with other types are rejected up front
+FIELD_TYPES = {
+    'id': (str, int),
+    'prompt': str,
+    'negative_prompt': str,
+    'size': str,
+    'n': int,
+    'prompt_extend': bool,
+    'watermark': bool,
+    'image': str,
+    'edit_prompt': str,
+    'target_ratio': str,
+    'max_dimension': int
+}
+
+def invalid_field(job):
+    """Name of the first field with a wrong type, or None"""
+    for field, types in FIELD_TYPES.items():
+        if field not in job:
+            continue
+        value = job[field]
+        # bool is an int in Python, but true is not a valid count
+        if not isinstance(value, types) or (isinstance(value, bool) and types is not bool):
+            return field
+    return None
+
+def load_jobs(path):
+    """Jobs from a JSONL file as [(job id, job)]; raises ValueError on malformed lines"""
+    jobs = {}
+    with open(path, 'r', encoding='utf-8') as f:
+        for number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                job = json.loads(line)
+            except ValueError:
+                raise ValueError(f'第 {number} 行不是有效的 JSON')
+            if not isinstance(job, dict):
+                raise ValueError(f'第 {number} 行不是 JSON 对象')
+            field = invalid_field(job)
+            if field:
+                raise ValueError(f'第 {number} 行的字段 {field} 类型不正确')
+            job_id = str(job.get('id') or hashlib.sha256(
+                json.dumps(job, sort_keys=True, ensure_ascii=False).encode('utf-8')).hexdigest()[:16])
+            if job_id in jobs:
+                if 'id' in job:
+                    raise ValueError(f'第 {number} 行的任务 id 重复: {job_id}')
+                # An identical line without an id is the same job
+                continue
+            jobs[job_id] = job
+    return list(jobs.items())
+
+class Checkpoint:
+    """Append-only progress log; the last event per job decides what a rerun does"""
+
+    def __init__(self, path):
+        self.path = path
+        self.events = {}
+        if os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # A line cut short by an interrupted write
+                        continue
+                    self.events[event['id']] = event
+
+    def last(self, job_id):
+        return self.events.get(job_id)
+
+    def record(self, job_id, event, **fields):
+        entry = {'id': job_id, 'event': event, 'at': time.time(), **fields}
+        self.events[job_id] = entry
+        # Opened per write so an interrupt never leaves buffered events behind
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+
+    def resumable_task(self, job_id):
+        """Task id of a submitted generation task whose result can still be fetched"""
+        event = self.last(job_id)
+        if event and event.get('task_id') and event['event'] in ('submitted', 'failed') \
+                and time.time() - event.get('submitted_at', event['at']) < TASK_RESULT_TTL:
+            return event['task_id'], event.get('submitted_at', event['at'])
+        return None, None
+
+class RateLimiter:
+    """Space submissions at least 1/rate seconds apart (rate 0 = unlimited)"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.next_at = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        # All callers run on the gateway loop, so no lock is needed
+        now = time.monotonic()
+        at = max(now, self.next_at)
+        self.next_at = at + self.interval
+        await asyncio.sleep(at - now)
+
+class JobFailed(Exception):
+    """A job that did not produce results; task_id is set when the task can still be polled"""
+
+    def __init__(self, message, task_id=None, submitted_at=None):
+        super().__init__(message)
+        self.task_id = task_id
+        self.submitted_at = submitted_at
+
+class BatchRunner:
+    """Run jobs with bounded concurrency and submission rate, checkpointing every step"""
+
+    def __init__(self, jobs, jobs_dir, output, concurrency=4, rate=2.0, poll_interval=3.0, task_timeout=600):
+        self.jobs = jobs
+        self.jobs_dir = jobs_dir
+        self.output = output
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.poll_interval = poll_interval
+        self.task_timeout = task_timeout
+        os.makedirs(output, exist_ok=True)
+        self.checkpoint = Checkpoint(os.path.join(output, 'checkpoint.jsonl'))
+        self.counts = {'completed': 0, 'failed': 0, 'skipped': 0}
+        self.finished = 0
+
+    async def run(self):
+        pending = []
+        for job_id, job in self.jobs:
+            event = self.checkpoint.last(job_id)
+            if event and event['event'] == 'completed':
+                self.counts['skipped'] += 1
+            else:
+                pending.append((job_id, job))
+        self.total = len(pending)
+        if self.counts['skipped']:
+            progress(f"跳过 {self.counts['skipped']} 个已完成的任务")
+
+        # Workers share one iterator, so at most `concurrency` jobs are in flight
+        jobs = iter(pending)
+        await asyncio.gather(*(self.worker(jobs) for _ in range(min(self.concurrency, len(pending)))))
+        return self.counts
+
+    async def worker(self, jobs):
+        for job_id, job in jobs:
+            started = time.time()
+            try:
+                files = await self.run_job(job_id, job)
+            except JobFailed as e:
+                self.fail(job_id, str(e), e.task_id, e.submitted_at)
+            except Exception as e:
+                # Any error fails only this job: it is checkpointed and retried on the next run,
+                # while the other jobs carry on
+                self.fail(job_id, str(e) or type(e).__name__)
+            else:
+                self.checkpoint.record(job_id, 'completed', files=files, seconds=round(time.time() - started, 2))
+                self.finished += 1
+                self.counts['completed'] += 1
+                progress(f"[{self.finished}/{self.total}] {job_id} 完成，{len(files)} 张图像"
+                         f"（{time.time() - started:.1f} 秒）")
+
+    async def run_job(self, job_id, job):
+        while True:
+            try:
+                if 'image' in job:
+                    return await self.run_edit(job_id, job)
+                return await self.run_generation(job_id, job)
+            except CircuitOpenError as e:
+                # DashScope is failing: wait for the circuit to allow calls again instead of failing every job
+                progress(f"{job_id} 上游服务暂时不可用，{math.ceil(e.retry_after)} 秒后重试")
+                await asyncio.sleep(e.retry_after)
+
+    def fail(self, job_id, error, task_id=None, submitted_at=None):
+        fields = {'error': error}
+        if task_id:
+            fields.update(task_id=task_id, submitted_at=submitted_at)
+        self.checkpoint.record(job_id, 'failed', **fields)
+        self.finished += 1
+        self.counts['failed'] += 1
+        progress(f"[{self.finished}/{self.total}] {job_id} 失败: {error}")
+
+    async def run_generation(self, job_id, job):
+        task_id, submitted_at = self.checkpoint.resumable_task(job_id)
+        if task_id is None:
+            payload, error = generation_payload(job)
+            if error:
+                raise JobFailed(error)
+            await self.limiter.wait()
+            headers = {'Content-Type': 'application/json', 'X-DashScope-Async': 'enable'}
+            response = await upstream.post_async('image-synthesis', headers, payload)
+            if response.status_code != 200:
+                raise JobFailed(f'API请求失败: {response.text}')
+            result = response.json()
+            status, urls, error = task_result(result)
+            if status == 'completed':
+                return await self.download(job_id, urls)
+            task_id = result.get('output', {}).get('task_id')
+            if not task_id:
+                raise JobFailed('图像生成失败')
+            submitted_at = time.time()
+            self.checkpoint.record(job_id, 'submitted', task_id=task_id, submitted_at=submitted_at)
+
+        urls = await self.wait_for_task(task_id, submitted_at)
+        try:
+            return await self.download(job_id, urls)
+        except (GatewayError, OSError) as e:
+            # The task succeeded, so a rerun only needs to download again
+            raise JobFailed(str(e), task_id, submitted_at)
+
+    async def wait_for_task(self, task_id, submitted_at):
+        """Poll a generation task until it finishes; returns its image URLs"""
+        deadline = time.monotonic() + self.task_timeout
+        while True:
+            try:
+                response = await upstream.get_async('task', {}, task_id=task_id)
+            except (GatewayError, NoKeyAvailableError):
+                # Keep polling; failing here would resubmit the task on the next run
+                response = None
+            if response is not None and response.status_code == 200:
+                status, urls, error = task_result(response.json())
+                if status == 'completed':
+                    return urls
+                if status == 'failed':
+                    raise JobFailed(error)
+            if time.monotonic() >= deadline:
+                raise JobFailed('等待任务结果超时', task_id, submitted_at)
+            await asyncio.sleep(self.poll_interval)
+
+    async def run_edit(self, job_id, job):
+        edit_prompt = job.get('edit_prompt') or job.get('prompt')
+        if not edit_prompt:
+            raise JobFailed('请输入编辑指令')
+        path = os.path.join(self.jobs_dir, job['image'])
+        raw = await asyncio.to_thread(read_file, path)
+        expansion = None
+        if job.get('target_ratio'):
+            expansion = (job['target_ratio'], int(job.get('max_dimension', 1536)))
+        try:
+            image, info = await asyncio.to_thread(preprocess_image, raw, expansion)
+        except Exception:
+            raise JobFailed(f"无法读取图像: {job['image']}")
+        width, height = info.get('out_width', info['width']), info.get('out_height', info['height'])
+        if width < MIN_EDGE or height < MIN_EDGE:
+            raise JobFailed(f'图像尺寸过小（{width}x{height}），宽高均需至少 {MIN_EDGE} 像素')
+
+        await self.limiter.wait()
+        response = await upstream.post_async(
+            'multimodal-generation', {'Content-Type': 'application/json'}, edit_payload(image, edit_prompt))
+        if response.status_code != 200:
+            raise JobFailed(f'API请求失败: {response.text}')
+        url = edit_result_url(response.json())
+        if not url:
+            raise JobFailed('图像编辑失败，未找到结果图像')
+        return await self.download(job_id, [url])
+
+    async def download(self, job_id, urls):
+        """Save result images into the output directory; returns their file names"""
+        if not urls:
+            raise JobFailed('图像生成失败，未返回结果图像')
+        name = re.sub(r'[^\w.-]', '_', job_id)[:100]
+        files = []
+        for index, url in enumerate(urls, 1):
+            response = await upstream.gateway.request('GET', url, timeout=(5, 60))
+            if response.status_code != 200:
+                raise GatewayError(f'结果图像下载失败: HTTP {response.status_code}')
+            content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+            ext = CONTENT_TYPE_EXTENSIONS.get(content_type, 'png')
+            filename = f"{name}.{ext}" if len(urls) == 1 else f"{name}_{index}.{ext}"
+            await asyncio.to_thread(write_file, os.path.join(self.output, filename), response.content)
+            files.append(filename)
+        return files
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+def write_file(path, data):
+    # Write to a temporary name first so an interrupt never leaves a truncated image
+    tmp_path = os.path.join(os.path.dirname(path), f".{uuid.uuid4()}.tmp")
+    try:
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+def progress(message):
+    print(message, file=sys.stderr, flush=True)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run a JSONL file of image generation/edit jobs')
+    parser.add_argument('jobs', help='JSONL file, one job per line')
+    parser.add_argument('--output', required=True, help='directory for result images and checkpoint.jsonl')
+    parser.add_argument('--concurrency', type=int, default=4, help='jobs in flight at once')
+    parser.add_argument('--rate', type=float, default=2.0, help='submissions per second (0 = unlimited)')
+    parser.add_argument('--poll-interval', type=float, default=3.0, help='seconds between task status polls')
+    parser.add_argument('--task-timeout', type=float, default=600, help='seconds to wait for one generation task')
+    parser.add_argument('--keys', default='api-key.json', help='API key file, in the format app.py reads')
+    parser.add_argument('--base-url', help='DashScope base URL (default: DASHSCOPE_BASE_URL or the public API)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    try:
+        with open(args.keys, 'r', encoding='utf-8') as f:
+            key_pool = KeyPool.from_config(json.load(f))
+    except (OSError, ValueError) as e:
+        sys.exit(f'无法读取 API 密钥文件 {args.keys}: {e}')
+    if not len(key_pool):
+        sys.exit(f'API 密钥文件 {args.keys} 中没有可用的密钥')
+    upstream.configure_keys(key_pool)
+    if args.base_url:
+        upstream.DASHSCOPE_BASE_URL = args.base_url.rstrip('/')
+
+    try:
+        jobs = load_jobs(args.jobs)
+    except (OSError, ValueError) as e:
+        sys.exit(f'无法读取任务文件: {e}')
+
+    runner = BatchRunner(
+        jobs,
+        os.path.dirname(os.path.abspath(args.jobs)),
+        args.output,
+        concurrency=max(1, args.concurrency),
+        rate=args.rate,
+        poll_interval=args.poll_interval,
+        task_timeout=args.task_timeout
+    )
+    started = time.time()
+    try:
+        counts = upstream.gateway.run(runner.run())
+    except KeyboardInterrupt:
+        progress('已中断，重新运行相同的命令即可从检查点继续')
+        sys.exit(130)
+    print(json.dumps({
+        'total': len(jobs),
+        **counts,
+        'seconds': round(time.time() - started, 1),
+        'output': os.path.abspath(args.output)
+    }, ensure_ascii=False, indent=2))
+    sys.exit(1 if counts['failed'] else 0)
+
+if __name__ == '__main__':
+    main()
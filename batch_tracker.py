@@ -0,0 +1,93 @@
+import threading
+import time
+import uuid
+from task_tracker import TERMINAL_STATUSES
+
+# Groups the tasks of one /generate-batch request so they can be watched together
+
+class BatchTracker:
+    """Keep per-item state for batches and notify waiters as items finish"""
+
+    def __init__(self, retention=3600):
+        self.retention = retention
+        self.batches = {}
+        self.task_items = {}
+        self.condition = threading.Condition()
+
+    def create(self, items):
+        """Register a batch of request items and return its id"""
+        batch_id = str(uuid.uuid4())
+        with self.condition:
+            self._prune(time.time())
+            self.batches[batch_id] = {
+                'items': [
+                    {'index': index, 'prompt': item.get('prompt', ''), 'status': 'submitting'}
+                    for index, item in enumerate(items)
+                ],
+                'version': 0,
+                'created_at': time.time(),
+                'finished_at': None
+            }
+        return batch_id
+
+    def update_item(self, batch_id, index, state):
+        """Record the latest state of one item"""
+        with self.condition:
+            batch = self.batches.get(batch_id)
+            if batch is None:
+                return
+            item = batch['items'][index]
+            item.update(state)
+            if state.get('task_id') and item['status'] not in TERMINAL_STATUSES:
+                self.task_items[state['task_id']] = (batch_id, index)
+            batch['version'] += 1
+            if all(i['status'] in TERMINAL_STATUSES for i in batch['items']):
+                batch['finished_at'] = time.time()
+            self.condition.notify_all()
+
+    def task_changed(self, task_id, state):
+        """Forward a task tracker state change to the batch item that owns it"""
+        with self.condition:
+            owner = self.task_items.get(task_id)
+            if owner and state['status'] in TERMINAL_STATUSES:
+                del self.task_items[task_id]
+        if owner:
+            self.update_item(owner[0], owner[1], state)
+
+    def get(self, batch_id):
+        """Return a snapshot of the batch, or None if unknown"""
+        with self.condition:
+            batch = self.batches.get(batch_id)
+            return self._snapshot(batch_id, batch) if batch else None
+
+    def wait(self, batch_id, version, timeout):
+        """Block until the batch moves past `version`; return (version, snapshot)"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                batch = self.batches.get(batch_id)
+                if batch is None:
+                    return version, None
+                if batch['version'] > version:
+                    return batch['version'], self._snapshot(batch_id, batch)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return version, self._snapshot(batch_id, batch)
+                self.condition.wait(remaining)
+
+    def _snapshot(self, batch_id, batch):
+        finished = sum(1 for item in batch['items'] if item['status'] in TERMINAL_STATUSES)
+        return {
+            'success': True,
+            'batch_id': batch_id,
+            'status': 'completed' if batch['finished_at'] else 'processing',
+            'total': len(batch['items']),
+            'finished': finished,
+            'items': [dict(item) for item in batch['items']]
+        }
+
+    def _prune(self, now):
+        expired = [batch_id for batch_id, batch in self.batches.items()
+                   if batch['finished_at'] and now - batch['finished_at'] > self.retention]
+        for batch_id in expired:
+            del self.batches[batch_id]
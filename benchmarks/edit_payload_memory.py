@@ -0,0 +1,99 @@
+"""Peak memory of sending one edit payload: buffered JSON vs the streaming encoder.
+
+Posts the qwen-image-edit payload for a noise JPEG of the given size to
+fake_dashscope (in a subprocess, so its buffers are not counted) through
+gateway.Gateway: once with the image as a data URI string serialized up
+front (the previous behaviour), once as json_stream.Base64Data encoded
+while it is sent. Peak allocations beyond the raw image are measured with
+tracemalloc and reported in MB and as a multiple of the raw image size.
+
+    python benchmarks/edit_payload_memory.py --megabytes 10 --output payload_memory.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from load_test import make_upload, free_port
+from gateway import Gateway
+from json_stream import Base64Data
+
+def edit_payload(image):
+    return {
+        'model': 'qwen-image-edit',
+        'input': {'messages': [{'role': 'user', 'content': [{'image': image}, {'text': '把背景换成海边'}]}]},
+        'parameters': {'negative_prompt': '', 'watermark': False}
+    }
+
+def measure(gateway, url, raw, streaming):
+    """Peak traced bytes and seconds to build and send one payload"""
+    tracemalloc.reset_peak()
+    baseline = tracemalloc.get_traced_memory()[0]
+    started = time.perf_counter()
+    image = Base64Data(raw, 'image/jpeg')
+    payload = edit_payload(image if streaming else image.data_uri())
+    response = gateway.run(gateway.request('POST', url, headers={'Content-Type': 'application/json'},
+                                           payload=payload))
+    elapsed = time.perf_counter() - started
+    peak = tracemalloc.get_traced_memory()[1] - baseline
+    if response.status_code != 200:
+        raise Exception(f'unexpected status {response.status_code}')
+    return {
+        'peak_mb': round(peak / 1024 / 1024, 1),
+        'peak_x_raw': round(peak / len(raw), 2),
+        'seconds': round(elapsed, 3)
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare peak memory of buffered and streamed edit payloads')
+    parser.add_argument('--megabytes', type=float, default=10, help='approximate raw image size')
+    parser.add_argument('--rounds', type=int, default=3, help='measurements per mode (the lowest peak is reported)')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    # Noise JPEG at quality 95 is about 1.2 bytes per pixel
+    edge = int((args.megabytes * 1024 * 1024 / 1.2) ** 0.5)
+    raw = make_upload(edge)
+    port = free_port()
+    server = subprocess.Popen(
+        [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fake_dashscope.py'),
+         '--port', str(port), '--edit-duration', '0', '--latency', '0', '--jitter', '0'],
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}/api/v1/services/aigc/multimodal-generation/generation"
+    gateway = Gateway()
+    report = {'config': {'raw_mb': round(len(raw) / 1024 / 1024, 1), 'rounds': args.rounds}}
+    try:
+        # Wait for the fake, and warm up the connection pool so its buffers are not counted
+        deadline = time.time() + 30
+        while True:
+            try:
+                gateway.run(gateway.request('POST', url, payload=edit_payload('')))
+                break
+            except Exception:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.2)
+        tracemalloc.start()
+        for mode, streaming in (('buffered', False), ('streaming', True)):
+            runs = [measure(gateway, url, raw, streaming) for _ in range(args.rounds)]
+            report[mode] = min(runs, key=lambda run: run['peak_mb'])
+        tracemalloc.stop()
+    finally:
+        gateway.close()
+        server.terminate()
+        server.wait(timeout=10)
+
+    report['peak_reduction'] = round(report['buffered']['peak_mb'] / max(report['streaming']['peak_mb'], 0.1), 1)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,237 @@
+"""Local DashScope stand-in for load testing without spending API credit.
+
+Implements the three endpoints app.py uses (text2image task submission, task
+query, multimodal-generation edit) plus the result image downloads, with
+configurable latency, failures, async task duration and 429 throttling.
+
+    python benchmarks/fake_dashscope.py --port 8900 --task-duration 8
+    DASHSCOPE_BASE_URL=http://127.0.0.1:8900 python app.py
+"""
+import argparse
+import io
+import json
+import random
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from PIL import Image
+
+class FakeConfig:
+    """Behaviour knobs for the fake server"""
+
+    def __init__(self, latency=0.05, jitter=0.02, failure_rate=0.0, task_duration=8.0,
+                 edit_duration=10.0, qps_limit=0.0, throttle_rate=0.0, image_size=1024):
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.task_duration = task_duration
+        self.edit_duration = edit_duration
+        self.qps_limit = qps_limit
+        self.throttle_rate = throttle_rate
+        self.image_size = image_size
+
+class FakeState:
+    """Tasks, rate-limit bucket and call counters shared by all handler threads"""
+
+    def __init__(self, config):
+        self.config = config
+        self.lock = threading.Lock()
+        self.tasks = {}
+        self.calls = Counter()
+        self.tokens = config.qps_limit
+        self.updated_at = time.monotonic()
+        buffer = io.BytesIO()
+        Image.new('RGB', (config.image_size, config.image_size), (120, 160, 200)).save(buffer, 'PNG')
+        self.image_bytes = buffer.getvalue()
+
+    def count(self, name):
+        with self.lock:
+            self.calls[name] += 1
+
+    def take_token(self):
+        """Return False when the request should be answered with 429"""
+        config = self.config
+        if config.throttle_rate and random.random() < config.throttle_rate:
+            return False
+        if not config.qps_limit:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(config.qps_limit, self.tokens + (now - self.updated_at) * config.qps_limit)
+            self.updated_at = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+class FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    state = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+        self.state.count(f"{self.endpoint}:{status}")
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            return self.rfile.read(length)
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int(self.rfile.readline().strip(), 16)
+                if size == 0:
+                    self.rfile.readline()
+                    break
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+            return b''.join(chunks)
+        return b''
+
+    def simulate_latency(self):
+        config = self.state.config
+        time.sleep(max(0.0, config.latency + random.uniform(-config.jitter, config.jitter)))
+
+    def check_faults(self):
+        """Apply throttling/failure injection; True if a response was already sent"""
+        if not self.state.take_token():
+            self.send_json({'code': 'Throttling.RateQuota', 'message': 'Requests rate limit exceeded'}, 429)
+            return True
+        if random.random() < self.state.config.failure_rate:
+            self.send_json({'code': 'InternalError', 'message': 'injected failure'}, 500)
+            return True
+        return False
+
+    def image_url(self):
+        host = self.headers.get('Host', f"127.0.0.1:{self.server.server_port}")
+        return f"http://{host}/images/{uuid.uuid4()}.png"
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path.endswith('/text2image/image-synthesis'):
+            self.endpoint = 'image-synthesis'
+            self.simulate_latency()
+            if self.check_faults():
+                return
+            payload = json.loads(body or b'{}')
+            task_id = str(uuid.uuid4())
+            with self.state.lock:
+                self.state.tasks[task_id] = {
+                    'done_at': time.time() + self.state.config.task_duration * random.uniform(0.8, 1.2),
+                    'n': payload.get('parameters', {}).get('n', 1)
+                }
+            self.send_json({'output': {'task_id': task_id, 'task_status': 'PENDING'}, 'request_id': str(uuid.uuid4())})
+        elif self.path.endswith('/multimodal-generation/generation'):
+            self.endpoint = 'multimodal-generation'
+            if self.check_faults():
+                return
+            time.sleep(self.state.config.edit_duration * random.uniform(0.8, 1.2))
+            self.send_json({
+                'output': {'choices': [{'message': {'role': 'assistant', 'content': [{'image': self.image_url()}]}}]},
+                'request_id': str(uuid.uuid4())
+            })
+        else:
+            self.endpoint = 'unknown'
+            self.send_json({'code': 'NotFound'}, 404)
+
+    def do_GET(self):
+        if self.path.startswith('/api/v1/tasks/'):
+            self.endpoint = 'task'
+            self.simulate_latency()
+            if self.check_faults():
+                return
+            task_id = self.path.rsplit('/', 1)[1]
+            with self.state.lock:
+                task = self.state.tasks.get(task_id)
+            if task is None:
+                self.send_json({'output': {'task_id': task_id, 'task_status': 'UNKNOWN'}})
+            elif time.time() < task['done_at']:
+                self.send_json({'output': {'task_id': task_id, 'task_status': 'RUNNING'}})
+            else:
+                results = [{'url': self.image_url()} for _ in range(task['n'])]
+                self.send_json({'output': {'task_id': task_id, 'task_status': 'SUCCEEDED', 'results': results}})
+        elif self.path.startswith('/images/'):
+            self.endpoint = 'image'
+            data = self.state.image_bytes
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/png')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+            self.state.count('image:200')
+        elif self.path == '/__stats':
+            self.endpoint = 'stats'
+            with self.state.lock:
+                calls = dict(self.state.calls)
+            data = json.dumps(calls).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.endpoint = 'unknown'
+            self.send_json({'code': 'NotFound'}, 404)
+
+class FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients hanging up mid-response are expected when a benchmark stops
+        if not isinstance(sys.exc_info()[1], (BrokenPipeError, ConnectionResetError)):
+            super().handle_error(request, client_address)
+
+def start_server(config, host='127.0.0.1', port=0):
+    """Start the fake server on a background thread; returns (server, state)"""
+    state = FakeState(config)
+    handler = type('BoundFakeHandler', (FakeHandler,), {'state': state})
+    server = FakeServer((host, port), handler)
+    threading.Thread(target=server.serve_forever, name='fake-dashscope', daemon=True).start()
+    return server, state
+
+def add_config_arguments(parser):
+    parser.add_argument('--latency', type=float, default=0.05, help='base response latency (s)')
+    parser.add_argument('--jitter', type=float, default=0.02, help='latency jitter (s)')
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='fraction of calls answered with 500')
+    parser.add_argument('--task-duration', type=float, default=8.0, help='async generation task duration (s)')
+    parser.add_argument('--edit-duration', type=float, default=10.0, help='synchronous edit call duration (s)')
+    parser.add_argument('--qps-limit', type=float, default=0.0, help='token-bucket QPS before 429 (0 = unlimited)')
+    parser.add_argument('--throttle-rate', type=float, default=0.0, help='fraction of calls answered with 429')
+    parser.add_argument('--image-size', type=int, default=1024, help='edge length of returned result images')
+
+def config_from_args(args):
+    return FakeConfig(
+        latency=args.latency,
+        jitter=args.jitter,
+        failure_rate=args.failure_rate,
+        task_duration=args.task_duration,
+        edit_duration=args.edit_duration,
+        qps_limit=args.qps_limit,
+        throttle_rate=args.throttle_rate,
+        image_size=args.image_size
+    )
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Fake DashScope server')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    server, _ = start_server(config_from_args(args), args.host, args.port)
+    print(f"Fake DashScope listening on http://{args.host}:{server.server_port}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
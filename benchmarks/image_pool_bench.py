@@ -0,0 +1,108 @@
+"""Inline vs process-pool image transforms under concurrent requests.
+
+Runs the same batch of uploads through image_pipeline.preprocess_image
+from N request threads, once transforming in those threads and once via
+image_pool.ImagePool. Reports images/s and latency percentiles, plus how
+late a 5 ms sleeper thread wakes up meanwhile (a stand-in for how much the
+transforms starve other request threads of the GIL).
+
+    python benchmarks/image_pool_bench.py --images 24 --edge 4000 --threads 8 --workers 4 --output pool.json
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from load_test import make_upload, summarize
+from image_pipeline import preprocess_image
+from image_pool import ImagePool
+
+def probe_lag(samples, stop_event, interval=0.005):
+    """Record how far past `interval` each sleep overruns"""
+    while not stop_event.is_set():
+        start = time.perf_counter()
+        time.sleep(interval)
+        samples.append(time.perf_counter() - start - interval)
+
+def run_mode(uploads, expansion, threads, pool):
+    latencies = []
+    errors = 0
+    lag = []
+    stop_event = threading.Event()
+    prober = threading.Thread(target=probe_lag, args=(lag, stop_event), daemon=True)
+
+    def one(raw):
+        start = time.perf_counter()
+        preprocess_image(raw, expansion, pool=pool)
+        return time.perf_counter() - start
+
+    prober.start()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        for future in [executor.submit(one, raw) for raw in uploads]:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                errors += 1
+    elapsed = time.perf_counter() - start
+    stop_event.set()
+    prober.join()
+
+    report = summarize(latencies, errors, elapsed)
+    report['images_per_s'] = report.pop('throughput_rps')
+    report['elapsed_s'] = round(elapsed, 2)
+    report['probe_lag'] = {k: v for k, v in summarize(lag, 0, 0).items() if k.endswith('_ms')}
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare inline and process-pool image transforms')
+    parser.add_argument('--images', type=int, default=16, help='uploads per run')
+    parser.add_argument('--edge', type=int, default=3000, help='edge of the noise JPEG uploads')
+    parser.add_argument('--ratio', default='16:9', help="expansion ratio, or '' for plain downscaling")
+    parser.add_argument('--max-dimension', type=int, default=1536, help='expansion output long edge')
+    parser.add_argument('--threads', type=int, default=8, help='concurrent request threads')
+    parser.add_argument('--workers', type=int, default=max(1, min(4, os.cpu_count() or 1)), help='pool processes')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    args = parser.parse_args()
+
+    # A few distinct images reused round-robin; generating each one costs more than transforming it
+    distinct = [make_upload(args.edge) for _ in range(min(args.images, 4))]
+    uploads = [distinct[i % len(distinct)] for i in range(args.images)]
+    expansion = (args.ratio, args.max_dimension) if args.ratio else None
+
+    pool = ImagePool(args.workers)
+    try:
+        # Warm up: spawn the workers and import PIL in them before timing
+        run_mode(uploads[:args.workers], expansion, args.workers, pool)
+        pooled = run_mode(uploads, expansion, args.threads, pool)
+    finally:
+        pool.shutdown()
+    inline = run_mode(uploads, expansion, args.threads, None)
+
+    report = {
+        'config': {
+            'images': args.images,
+            'edge': args.edge,
+            'upload_bytes': len(distinct[0]),
+            'expansion': list(expansion) if expansion else None,
+            'threads': args.threads,
+            'workers': args.workers,
+            'cpu_count': os.cpu_count()
+        },
+        'inline': inline,
+        'pool': pooled,
+        'speedup': round(pooled['images_per_s'] / inline['images_per_s'], 2) if inline['images_per_s'] else None
+    }
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+"""Load/latency benchmark for app.py against the local DashScope stand-in.
+
+Starts fake_dashscope in-process, launches the Flask app in a subprocess
+pointed at it via DASHSCOPE_BASE_URL, then drives /generate-image,
+/check-task and /edit-image with concurrent virtual users. Prints (and
+optionally writes) a JSON report with throughput, latency percentiles,
+server memory and upstream call counts, so regression runs can be diffed.
+
+    python benchmarks/load_test.py --generate-users 20 --edit-users 5 --duration 60 --output bench.json
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+import requests
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_dashscope import start_server, add_config_arguments, config_from_args
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class Recorder:
+    """Thread-safe latency and error collection per operation"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def record(self, name, seconds, ok=True):
+        with self.lock:
+            if ok:
+                self.latencies[name].append(seconds)
+            else:
+                self.errors[name] += 1
+
+    def summary(self, elapsed):
+        with self.lock:
+            names = set(self.latencies) | set(self.errors)
+            return {name: summarize(self.latencies[name], self.errors[name], elapsed) for name in sorted(names)}
+
+def percentile(values, pct):
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+    return round(values[index] * 1000, 1)
+
+def summarize(latencies, errors, elapsed):
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'errors': errors,
+        'throughput_rps': round(len(values) / elapsed, 2) if elapsed else 0,
+        'p50_ms': percentile(values, 50),
+        'p95_ms': percentile(values, 95),
+        'p99_ms': percentile(values, 99),
+        'max_ms': round(values[-1] * 1000, 1) if values else None
+    }
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def read_memory_kb(pid):
+    """Current and peak RSS of a process from /proc (Linux only)"""
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith(('VmRSS:', 'VmHWM:')):
+                    key, value = line.split(':', 1)
+                    memory[key] = int(value.split()[0])
+    except OSError:
+        pass
+    return memory
+
+def make_upload(edge, quality=95):
+    """Noise JPEG, so compression can't shrink it below a realistic multi-MB size"""
+    img = Image.frombytes('RGB', (edge, edge), os.urandom(edge * edge * 3))
+    buffer = io.BytesIO()
+    img.save(buffer, 'JPEG', quality=quality)
+    return buffer.getvalue()
+
+def start_app(port, fake_url, server_command, extra_env):
+    env = dict(os.environ, DASHSCOPE_BASE_URL=fake_url, **extra_env)
+    if server_command:
+        command = server_command.format(port=port, python=sys.executable).split()
+    else:
+        command = [sys.executable, '-c',
+                   f"from app import app; app.run(host='127.0.0.1', port={port}, threaded=True)"]
+    process = subprocess.Popen(command, cwd=REPO_ROOT, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f"http://127.0.0.1:{port}"
+    deadline = time.time() + 30
+    while time.time() < deadline:
+        try:
+            requests.get(base_url + '/', timeout=1)
+            return process, base_url
+        except requests.RequestException:
+            time.sleep(0.2)
+    process.terminate()
+    raise RuntimeError('app did not start within 30s')
+
+def wait_for_result(session, url, recorder, name, poll_interval, stop_at):
+    """Poll a status endpoint until it reports a terminal state (None if the run ends first)"""
+    while time.time() < stop_at:
+        start = time.perf_counter()
+        try:
+            data = session.get(url, timeout=30).json()
+        except (requests.RequestException, ValueError):
+            recorder.record(name, 0, ok=False)
+            return False
+        recorder.record(name, time.perf_counter() - start)
+        if data.get('status') == 'completed':
+            return True
+        if data.get('status') == 'failed':
+            return False
+        time.sleep(poll_interval)
+    return None
+
+def generate_user(base_url, recorder, stop_at, poll_interval, user_id):
+    session = requests.Session()
+    iteration = 0
+    while time.time() < stop_at:
+        iteration += 1
+        begin = time.perf_counter()
+        try:
+            response = session.post(base_url + '/generate-image', json={
+                'prompt': f"benchmark user {user_id} image {iteration}",
+                'size': '1328*1328',
+                'no_cache': True
+            }, timeout=60)
+            data = response.json()
+            ok = response.status_code == 200 and data.get('success')
+        except (requests.RequestException, ValueError):
+            ok, data = False, {}
+        recorder.record('POST /generate-image', time.perf_counter() - begin, ok)
+        if not ok:
+            continue
+        if data.get('task_id') and not data.get('image_url'):
+            ok = wait_for_result(session, f"{base_url}/check-task/{data['task_id']}",
+                                 recorder, 'GET /check-task', poll_interval, stop_at)
+        if ok is not None:
+            recorder.record('generate end-to-end', time.perf_counter() - begin, ok)
+
+def edit_user(base_url, recorder, stop_at, poll_interval, upload, user_id):
+    session = requests.Session()
+    iteration = 0
+    while time.time() < stop_at:
+        iteration += 1
+        begin = time.perf_counter()
+        try:
+            response = session.post(base_url + '/edit-image', files={
+                'image': (f"bench_{user_id}.jpg", upload, 'image/jpeg')
+            }, data={
+                'edit_prompt': f"benchmark edit {user_id}-{iteration}",
+                'no_cache': 'true'
+            }, timeout=120)
+            data = response.json()
+            ok = response.status_code == 200 and data.get('success')
+        except (requests.RequestException, ValueError):
+            ok, data = False, {}
+        recorder.record('POST /edit-image', time.perf_counter() - begin, ok)
+        if not ok:
+            continue
+        if data.get('job_id'):
+            ok = wait_for_result(session, f"{base_url}/jobs/{data['job_id']}",
+                                 recorder, 'GET /jobs', poll_interval, stop_at)
+        if ok is not None:
+            recorder.record('edit end-to-end', time.perf_counter() - begin, ok)
+
+def sample_memory(pid, samples, stop_event):
+    while not stop_event.wait(0.5):
+        samples.append(read_memory_kb(pid).get('VmRSS', 0))
+
+def run(args):
+    fake_server, fake_state = start_server(config_from_args(args))
+    fake_url = f"http://127.0.0.1:{fake_server.server_port}"
+
+    # Everything the app writes goes to a scratch directory, so runs neither
+    # pollute the working tree's history and uploads nor see each other's state
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    extra_env = {
+        'RESULT_CACHE_DIR': os.path.join(workdir, 'results-cache'),
+        'TASK_JOURNAL_PATH': os.path.join(workdir, 'tasks.db'),
+        'UPLOAD_FOLDER': os.path.join(workdir, 'uploads'),
+        'RESULTS_FOLDER': os.path.join(workdir, 'results'),
+        'PREVIEW_FOLDER': os.path.join(workdir, 'previews'),
+        'MIRROR_RESULTS': '1' if args.mirror else '0'
+    }
+    process, base_url = start_app(args.port or free_port(), fake_url, args.server_command, extra_env)
+    upload = make_upload(args.upload_edge)
+
+    recorder = Recorder()
+    memory_samples = []
+    stop_event = threading.Event()
+    sampler = threading.Thread(target=sample_memory, args=(process.pid, memory_samples, stop_event), daemon=True)
+    sampler.start()
+
+    start = time.time()
+    stop_at = start + args.duration
+    users = [threading.Thread(target=generate_user, args=(base_url, recorder, stop_at, args.poll_interval, i))
+             for i in range(args.generate_users)]
+    users += [threading.Thread(target=edit_user, args=(base_url, recorder, stop_at, args.poll_interval, upload, i))
+              for i in range(args.edit_users)]
+    try:
+        for user in users:
+            user.start()
+        for user in users:
+            user.join()
+        elapsed = time.time() - start
+        memory = read_memory_kb(process.pid)
+    finally:
+        stop_event.set()
+        process.terminate()
+        process.wait(timeout=10)
+        fake_server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    with fake_state.lock:
+        upstream_calls = dict(fake_state.calls)
+
+    return {
+        'config': {
+            'generate_users': args.generate_users,
+            'edit_users': args.edit_users,
+            'duration_s': args.duration,
+            'poll_interval_s': args.poll_interval,
+            'upload_bytes': len(upload),
+            'fake': vars(config_from_args(args)),
+            'server_command': args.server_command or 'flask dev server (threaded)'
+        },
+        'elapsed_s': round(elapsed, 2),
+        'requests': recorder.summary(elapsed),
+        'server_memory_mb': {
+            'final_rss': round(memory.get('VmRSS', 0) / 1024, 1),
+            'peak_rss': round(memory.get('VmHWM', 0) / 1024, 1),
+            'mean_rss': round(sum(memory_samples) / len(memory_samples) / 1024, 1) if memory_samples else None
+        },
+        'upstream_calls': upstream_calls,
+        'upstream_calls_total': sum(upstream_calls.values())
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark app.py against a fake DashScope')
+    parser.add_argument('--generate-users', type=int, default=10, help='concurrent generate users')
+    parser.add_argument('--edit-users', type=int, default=4, help='concurrent edit users')
+    parser.add_argument('--duration', type=float, default=30.0, help='test duration (s)')
+    parser.add_argument('--poll-interval', type=float, default=3.0, help='client status poll interval (s)')
+    parser.add_argument('--upload-edge', type=int, default=2048, help='edge of the noise JPEG uploaded for edits')
+    parser.add_argument('--mirror', action='store_true', help='keep result mirroring enabled')
+    parser.add_argument('--port', type=int, default=0, help='app port (default: random free port)')
+    parser.add_argument('--server-command', default='',
+                        help='command to start the app; {port} and {python} are substituted')
+    parser.add_argument('--output', help='write the JSON report to this file')
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    report = run(args)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(text)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+from gateway import GatewayError
+from structured_logging import log_event
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Fail fast while DashScope is degraded instead of letting every call wait
+# out its timeout. A breaker opens after a run of consecutive failures, or
+# when failures (timeouts, connection errors, 5xx) make up too large a share
+# of recent calls; after a cool-down a single probe call decides whether it
+# closes again or stays open for twice as long.
+
+class CircuitOpenError(GatewayError):
+    """Raised without contacting upstream while a circuit is open"""
+
+    def __init__(self, retry_after):
+        super().__init__(f'上游服务暂时不可用，请 {math.ceil(retry_after)} 秒后重试')
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Closed / open / half-open breaker for one upstream endpoint"""
+
+    def __init__(self, name, consecutive_failures=5, failure_ratio=0.5, window=30.0, min_calls=10,
+                 open_seconds=30.0, max_open_seconds=300.0):
+        self.name = name
+        self.consecutive_failures = consecutive_failures
+        self.failure_ratio = failure_ratio
+        self.window = window
+        self.min_calls = min_calls
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.state = 'closed'
+        self.outcomes = deque()
+        self.streak = 0
+        self.opened = 0
+        self.open_until = 0.0
+        self.probing = False
+        self.lock = threading.Lock()
+
+    def before_request(self):
+        """Admit a call, or raise CircuitOpenError; every admitted call must be followed by record()"""
+        with self.lock:
+            now = time.monotonic()
+            if self.state == 'open':
+                if now < self.open_until:
+                    raise CircuitOpenError(self.open_until - now)
+                self._transition('half_open')
+            if self.state == 'half_open':
+                if self.probing:
+                    raise CircuitOpenError(min(5.0, self.open_seconds))
+                self.probing = True
+
+    def record(self, failed):
+        """Outcome of an admitted call; None when it ended without a verdict (e.g. cancelled)"""
+        with self.lock:
+            now = time.monotonic()
+            if self.state == 'half_open':
+                self.probing = False
+                if failed:
+                    self._trip(now)
+                elif failed is not None:
+                    self.opened = 0
+                    self.outcomes.clear()
+                    self.streak = 0
+                    self._transition('closed')
+                return
+            if self.state != 'closed' or failed is None:
+                # Calls admitted before the circuit opened
+                return
+
+            self.outcomes.append((now, failed))
+            while self.outcomes and self.outcomes[0][0] < now - self.window:
+                self.outcomes.popleft()
+            self.streak = self.streak + 1 if failed else 0
+            failures = sum(1 for _, outcome in self.outcomes if outcome)
+            if self.streak >= self.consecutive_failures or (
+                    len(self.outcomes) >= self.min_calls and failures / len(self.outcomes) >= self.failure_ratio):
+                self._trip(now)
+
+    def retry_after(self):
+        """Seconds until calls are admitted again, or None if they are admitted now"""
+        with self.lock:
+            if self.state == 'open':
+                remaining = self.open_until - time.monotonic()
+                return remaining if remaining > 0 else None
+            if self.state == 'half_open' and self.probing:
+                return min(5.0, self.open_seconds)
+            return None
+
+    def stats(self):
+        with self.lock:
+            return {
+                'state': self.state,
+                'recent_calls': len(self.outcomes),
+                'recent_failures': sum(1 for _, outcome in self.outcomes if outcome),
+                'retry_after': round(max(0.0, self.open_until - time.monotonic()), 1) if self.state == 'open' else None
+            }
+
+    def _trip(self, now):
+        # Each failed probe doubles the cool-down, up to max_open_seconds
+        seconds = min(self.max_open_seconds, self.open_seconds * (2 ** self.opened))
+        self.opened += 1
+        self.open_until = now + seconds
+        self.outcomes.clear()
+        self.streak = 0
+        self._transition('open', open_seconds=seconds)
+
+    def _transition(self, state, **fields):
+        self.state = state
+        metrics.UPSTREAM_CIRCUIT.inc(endpoint=self.name, state=state)
+        log_event(logger, logging.WARNING if state == 'open' else logging.INFO,
+                  'upstream_circuit_' + state, endpoint=self.name, **fields)
@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+import threading
+import aiohttp
+from json_stream import JsonStream, contains_binary
+
+# One asyncio event loop on a background thread that multiplexes every
+# in-flight upstream request over a shared aiohttp connection pool, so a
+# 60-second edit call costs a coroutine rather than an OS thread
+
+class GatewayError(Exception):
+    """Connection-level failure talking to the upstream (no HTTP response)"""
+
+class GatewayTimeout(GatewayError):
+    """The upstream did not connect or respond within the timeout"""
+
+class GatewayResponse:
+    """A fully read upstream response with the parts of requests.Response callers use"""
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+class Gateway:
+    """Run coroutines on a private event loop thread; usable from any thread"""
+
+    def __init__(self, max_connections=256, keepalive_timeout=30):
+        self.max_connections = max_connections
+        self.keepalive_timeout = keepalive_timeout
+        self.lock = threading.Lock()
+        self.loop = None
+        self.thread = None
+        self.session = None
+        self.pid = None
+        self.in_flight = 0
+
+    def _ensure_loop(self):
+        # Started lazily, and again in each forked worker (threads do not survive a fork)
+        with self.lock:
+            if self.loop is None or self.pid != os.getpid():
+                self.loop = asyncio.new_event_loop()
+                self.session = None
+                self.pid = os.getpid()
+                self.thread = threading.Thread(target=self.loop.run_forever, name='upstream-gateway', daemon=True)
+                self.thread.start()
+            return self.loop
+
+    def submit(self, coro):
+        """Schedule a coroutine on the gateway loop; returns a concurrent.futures.Future"""
+        return asyncio.run_coroutine_threadsafe(coro, self._ensure_loop())
+
+    def run(self, coro, timeout=None):
+        """Run a coroutine on the gateway loop and block the calling thread for its result"""
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except BaseException:
+            # Caller gave up (timeout, interrupt): cancel the request on the loop too
+            future.cancel()
+            raise
+
+    async def request(self, method, url, headers=None, payload=None, timeout=(5, 60)):
+        """Send one HTTP request on the shared pool and read the whole body.
+
+        Payloads holding json_stream.Base64Data are encoded while being sent,
+        with chunked transfer encoding, instead of being serialized up front.
+        """
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=self.keepalive_timeout)
+            self.session = aiohttp.ClientSession(connector=connector)
+        connect_timeout, read_timeout = timeout
+        body = {'data': JsonStream(payload)} if contains_binary(payload) else {'json': payload}
+        self.in_flight += 1
+        try:
+            async with self.session.request(
+                method,
+                url,
+                headers=headers,
+                timeout=aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout),
+                **body
+            ) as response:
+                content = await response.read()
+                return GatewayResponse(response.status, response.headers.copy(), content)
+        except asyncio.TimeoutError as e:
+            raise GatewayTimeout('上游请求超时') from e
+        except aiohttp.ClientError as e:
+            raise GatewayError(f'上游连接失败: {e}') from e
+        finally:
+            self.in_flight -= 1
+
+    def stats(self):
+        """Requests in flight and the connection pool limit"""
+        return {'in_flight': self.in_flight, 'max_connections': self.max_connections}
+
+    def close(self, timeout=5):
+        """Close the connection pool and stop the loop thread"""
+        with self.lock:
+            loop, session = self.loop, self.session
+            if loop is None or self.pid != os.getpid():
+                return
+            self.loop = self.session = None
+        if session is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(session.close(), loop).result(timeout)
+            except Exception:
+                pass
+        loop.call_soon_threadsafe(loop.stop)
+        self.thread.join(timeout)
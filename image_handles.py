@@ -0,0 +1,94 @@
+import re
+import threading
+from collections import OrderedDict
+
+# Server-side handles for images that are edited repeatedly. A handle names
+# an edit input that is ready to send upstream (preprocessed bytes, or a result URL
+# DashScope can fetch itself), so an edit chain uploads and preprocesses its
+# image once. Handles describe how to rebuild their input, so one that has
+# been evicted, or was created in another worker process, still resolves:
+#
+#   <upload name>                      stored upload, sent as-is (or downscaled)
+#   <upload name>@<ratio>,<max edge>   stored upload, expanded to a ratio
+#   job:<job id>                       result image of a completed edit job
+#   result:<result name>               mirrored result image
+
+UPLOAD_HANDLE = re.compile(r'^([0-9a-f]{64}\.[a-z0-9]+)(?:@(\d{1,2}:\d{1,2}),(\d{3,4}))?$')
+REFERENCE_HANDLE = re.compile(r'^(job|result):([\w.-]{1,128})$')
+
+class HandleUnavailable(Exception):
+    """A handle that cannot be resolved (unknown, expired, or its job is not finished)"""
+
+    def __init__(self, message, status=404):
+        super().__init__(message)
+        self.status = status
+
+def make_handle(upload_name, expansion=None):
+    """Handle for a stored upload with optional (target_ratio, max_dimension) expansion"""
+    if expansion:
+        return f"{upload_name}@{expansion[0]},{expansion[1]}"
+    return upload_name
+
+def parse_handle(handle):
+    """('upload', upload name, expansion) or ('job' | 'result', id, None); None if malformed"""
+    match = UPLOAD_HANDLE.match(handle or '')
+    if match:
+        name, ratio, max_dimension = match.groups()
+        return 'upload', name, (ratio, int(max_dimension)) if ratio else None
+    match = REFERENCE_HANDLE.match(handle or '')
+    if match:
+        return match.group(1), match.group(2), None
+    return None
+
+class HandleCache:
+    """Prepared edit inputs by handle, LRU-evicted to stay within a memory budget.
+
+    Entries are dicts with at least 'image' (what goes in the API payload) and
+    'digest' (identifies the source image for the result cache). On a miss,
+    load(handle) rebuilds the entry or raises HandleUnavailable.
+    """
+
+    def __init__(self, load, max_bytes=128 * 1024 * 1024):
+        self.load = load
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.counts = {'hit': 0, 'miss': 0}
+        self.lock = threading.Lock()
+
+    def get(self, handle):
+        with self.lock:
+            entry = self.entries.get(handle)
+            if entry is not None:
+                self.entries.move_to_end(handle)
+                self.counts['hit'] += 1
+                return dict(entry)
+            self.counts['miss'] += 1
+        if parse_handle(handle) is None:
+            raise HandleUnavailable('无效的图像句柄', 400)
+        entry = self.load(handle)
+        self.put(handle, entry)
+        return dict(entry)
+
+    def put(self, handle, entry):
+        size = len(entry['image'])
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(handle, None)
+            if old is not None:
+                self.total_bytes -= len(old['image'])
+            self.entries[handle] = dict(entry)
+            self.total_bytes += size
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.total_bytes -= len(evicted['image'])
+
+    def stats(self):
+        with self.lock:
+            return {
+                **self.counts,
+                'entries': len(self.entries),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes
+            }
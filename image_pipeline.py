@@ -0,0 +1,149 @@
+import io
+import time
+from PIL import Image
+import metrics
+from json_stream import Base64Data
+
+# In-memory preprocessing for edit uploads: decode -> optional pad/resize -> encode.
+# The result stays binary; it is base64-encoded only while the request is sent.
+
+# qwen-image-edit input limits
+MIN_EDGE = 384
+MAX_EDGE = 3072
+MAX_BYTES = 10 * 1024 * 1024
+
+def expanded_size(width, height, target_ratio):
+    """Size of the padded canvas expand_image_to_ratio() builds for an image"""
+    ratio_width, ratio_height = (float(part) for part in target_ratio.split(':'))
+    target_aspect = ratio_width / ratio_height
+    if width / height > target_aspect:
+        return width, int(width / target_aspect)
+    return int(height * target_aspect), height
+
+def apply_draft(img, scale):
+    """Let JPEG decoding skip resolution that a downscale by `scale` would discard.
+
+    Draft mode decodes at 1/2, 1/4 or 1/8 scale, never below the requested size.
+    """
+    if img.format in ('JPEG', 'MPO') and scale < 1:
+        img.draft('RGB', (max(1, int(img.width * scale)), max(1, int(img.height * scale))))
+
+def scale_to_fit(img, max_dimension):
+    """Resize so neither edge exceeds max_dimension (never enlarges)"""
+    scale = max_dimension / max(img.size)
+    if scale >= 1:
+        return img
+    size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+    return img.resize(size, Image.Resampling.LANCZOS, reducing_gap=2.0)
+
+def expand_image_to_ratio(img, target_ratio, max_dimension):
+    """Expand image to target aspect ratio with white padding and resize to max dimension"""
+    # Palette/bilevel/CMYK images cannot be resampled with LANCZOS
+    if img.mode not in ('RGB', 'RGBA', 'L'):
+        img = img.convert('RGB')
+
+    # Resize before padding, so the full-size canvas is never allocated
+    canvas_width, canvas_height = expanded_size(img.width, img.height, target_ratio)
+    scale = min(1.0, max_dimension / max(canvas_width, canvas_height))
+    img = scale_to_fit(img, max(1, round(max(img.size) * scale)))
+    new_width = max(img.width, round(canvas_width * scale))
+    new_height = max(img.height, round(canvas_height * scale))
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+
+    # Create new image with white background
+    expanded_img = Image.new('RGB', (new_width, new_height), 'white')
+
+    # Paste image centered onto white background
+    paste_x = (new_width - img.width) // 2
+    paste_y = (new_height - img.height) // 2
+    expanded_img.paste(img, (paste_x, paste_y))
+
+    return expanded_img
+
+def transform_image(fp, expansion=None):
+    """Decode, scale (and pad, if `expansion` is given) and JPEG-encode an image.
+
+    Self-contained so it can run inline or in an image_pool worker process.
+    Returns (jpeg bytes, info, {stage: seconds}).
+    """
+    timings = {}
+    started = time.perf_counter()
+    img = Image.open(fp)
+    if expansion:
+        target_ratio, max_dimension = expansion
+        max_dimension = min(max_dimension, MAX_EDGE)
+        canvas = expanded_size(img.width, img.height, target_ratio)
+    else:
+        max_dimension = MAX_EDGE
+        canvas = img.size
+    apply_draft(img, max_dimension / max(canvas))
+    img.load()
+    decoded_size = img.size
+    now = time.perf_counter()
+    timings['decode'], started = now - started, now
+
+    if expansion:
+        out_img = expand_image_to_ratio(img, target_ratio, max_dimension)
+    else:
+        out_img = scale_to_fit(img if img.mode in ('RGB', 'L') else img.convert('RGB'), max_dimension)
+        if out_img.mode != 'RGB':
+            out_img = out_img.convert('RGB')
+    now = time.perf_counter()
+    timings['expand'], started = now - started, now
+
+    buffer = io.BytesIO()
+    out_img.save(buffer, 'JPEG', quality=95)
+    data = buffer.getvalue()
+    timings['encode'] = time.perf_counter() - started
+    info = {
+        'out_width': out_img.width,
+        'out_height': out_img.height,
+        'out_size': len(data),
+        'decoded_width': decoded_size[0],
+        'decoded_height': decoded_size[1]
+    }
+    return data, info, timings
+
+def preprocess_image(raw, expansion=None, debug_store=None, pool=None):
+    """Turn uploaded image bytes into the image for an edit payload without touching disk.
+
+    `expansion` is an optional (target_ratio, max_dimension) tuple. When it is
+    omitted and the upload is within the API limits, the original bytes are
+    passed through untouched, so the image is never fully decoded; larger
+    uploads are scaled down to fit MAX_EDGE instead. Transforms run on `pool`
+    (an image_pool.ImagePool) when given. Returns (json_stream.Base64Data, info).
+    """
+    # Image.open only parses the header until pixel data is needed
+    started = time.perf_counter()
+    img = Image.open(io.BytesIO(raw))
+    info = {
+        'width': img.width,
+        'height': img.height,
+        'format': img.format,
+        'mode': img.mode,
+        'size': len(raw)
+    }
+
+    if expansion or max(img.size) > MAX_EDGE or len(raw) > MAX_BYTES:
+        if pool:
+            data, out_info, timings = pool.transform(raw, expansion, img.size)
+        else:
+            data, out_info, timings = transform_image(io.BytesIO(raw), expansion)
+        info.update(out_info)
+        mime_type = 'image/jpeg'
+    else:
+        # Verify the upload is a decodable image before forwarding it as-is
+        img.verify()
+        timings = {'decode': time.perf_counter() - started}
+        data = raw
+        # Pillow reports camera JPEGs with embedded previews as MPO; they are still JPEG files
+        mime_type = 'image/jpeg' if img.format == 'MPO' else Image.MIME.get(img.format, f"image/{img.format.lower()}")
+
+    if debug_store:
+        # Opt-in persistence of exactly what is sent upstream, for debugging
+        debug_store.put(data, 'jpg' if mime_type == 'image/jpeg' else img.format.lower())
+
+    for stage, seconds in timings.items():
+        metrics.PREPROCESS_DURATION.observe(seconds, stage=stage)
+    return Base64Data(data, mime_type), info
@@ -0,0 +1,114 @@
+import io
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from image_pipeline import transform_image, MAX_EDGE
+
+# Bounded process pool for CPU-heavy image transforms (decode, resize, pad,
+# JPEG encode), so they stop contending for the GIL with request threads.
+# Each job gets one shared-memory block: the parent copies the upload into
+# it and the worker writes the encoded result back, so neither payload is
+# pickled through the pool's pipes.
+
+class SharedBufferReader(io.RawIOBase):
+    """Seekable read-only file object over a memoryview, without copying it"""
+
+    def __init__(self, view):
+        self.view = view
+        self.position = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def readinto(self, buffer):
+        count = max(0, min(len(buffer), len(self.view) - self.position))
+        buffer[:count] = self.view[self.position:self.position + count]
+        self.position += count
+        return count
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        base = {io.SEEK_SET: 0, io.SEEK_CUR: self.position, io.SEEK_END: len(self.view)}[whence]
+        self.position = max(0, base + offset)
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def close(self):
+        if not self.closed:
+            self.view.release()
+        super().close()
+
+def run_transform(block_name, input_size, output_capacity, expansion):
+    """Worker side: transform the image in a shared block and write the JPEG back after it"""
+    # Spawned workers share the parent's resource tracker, so attaching here
+    # does not leave a second registration behind once the parent unlinks
+    block = shared_memory.SharedMemory(name=block_name)
+    try:
+        with io.BufferedReader(SharedBufferReader(block.buf[:input_size])) as reader:
+            data, info, timings = transform_image(reader, expansion)
+        if len(data) > output_capacity:
+            return len(data), data, info, timings
+        block.buf[input_size:input_size + len(data)] = data
+        return len(data), None, info, timings
+    finally:
+        block.close()
+
+class ImagePool:
+    """Run image transforms (image_pipeline, previews) in worker processes, with bounded pending jobs"""
+
+    def __init__(self, workers=2, max_pending=None):
+        self.workers = workers
+        self.slots = threading.BoundedSemaphore(max_pending or workers * 2)
+        self.lock = threading.Lock()
+        self.executor = None
+        self.pid = None
+
+    def transform(self, raw, expansion, size):
+        """Same contract as transform_image(); `size` is the input (width, height) from its header"""
+        # Room for the result: uncompressed RGB at the output size is an upper bound in practice
+        if expansion:
+            max_dimension = min(expansion[1], MAX_EDGE)
+            output_pixels = min(max(size) ** 2, max_dimension ** 2)
+        else:
+            output_pixels = min(size[0] * size[1], MAX_EDGE ** 2)
+        output_capacity = output_pixels * 3 + 64 * 1024
+        with self.slots:
+            block = shared_memory.SharedMemory(create=True, size=len(raw) + output_capacity)
+            try:
+                block.buf[:len(raw)] = raw
+                future = self._ensure_executor().submit(
+                    run_transform, block.name, len(raw), output_capacity, expansion)
+                length, data, info, timings = future.result()
+                if data is None:
+                    data = bytes(block.buf[len(raw):len(raw) + length])
+                return data, info, timings
+            finally:
+                block.close()
+                block.unlink()
+
+    def run(self, fn, *args):
+        """Run a module-level function in a worker process and return its result"""
+        with self.slots:
+            return self._ensure_executor().submit(fn, *args).result()
+
+    def shutdown(self, wait=True):
+        with self.lock:
+            executor, self.executor = self.executor, None
+        if executor is not None and self.pid == os.getpid():
+            executor.shutdown(wait=wait, cancel_futures=True)
+
+    def _ensure_executor(self):
+        # Created lazily, and again in each forked server worker
+        with self.lock:
+            if self.executor is None or self.pid != os.getpid():
+                # spawn: forking a process that already runs threads can deadlock the child
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.workers, mp_context=multiprocessing.get_context('spawn'))
+                self.pid = os.getpid()
+            return self.executor
@@ -0,0 +1,318 @@
+import asyncio
+import math
+import threading
+import time
+import uuid
+from collections import deque
+import metrics
+
+# Bounded worker pool for long-running upstream jobs (image edits). Jobs are
+# coroutine functions run on the gateway's event loop, so a waiting job holds
+# no thread. Jobs are queued per client and started in weighted round-robin
+# order, so a client with many jobs cannot hold every worker while others
+# wait; jobs that would wait longer than max_wait are shed instead of piling up
+
+class QueueFullError(Exception):
+    """Raised when a job is refused: the queue is full or its expected wait is too long"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class FairSlots:
+    """Worker slots handed out by smooth weighted round-robin across per-client queues.
+
+    Used only from the gateway's event loop, so it needs no lock.
+    """
+
+    def __init__(self, limit, weight):
+        self.limit = limit
+        self.weight = weight
+        self.active = 0
+        self.waiters = {}
+        self.current = {}
+
+    async def acquire(self, client):
+        if self.active < self.limit and not self.waiters:
+            self.active += 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(client, deque()).append(future)
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Granted a slot in the same step as the cancellation: hand it on
+                self.release()
+            else:
+                self._remove(client, future)
+            raise
+
+    def release(self):
+        self.active -= 1
+        while self.active < self.limit and self.waiters:
+            client = self._next_client()
+            queue = self.waiters[client]
+            future = queue.popleft()
+            if not queue:
+                self._remove(client, None)
+            if future.done():
+                # Cancelled (deadline or /cancel) but its task has not run yet to remove it
+                continue
+            self.active += 1
+            future.set_result(None)
+
+    def _next_client(self):
+        # As in nginx: each waiting client gains its weight, the highest is picked and pays the total,
+        # so clients are interleaved evenly in proportion to their weights
+        total = 0
+        chosen = None
+        for client in self.waiters:
+            weight = self.weight(client)
+            total += weight
+            self.current[client] = self.current.get(client, 0) + weight
+            if chosen is None or self.current[client] > self.current[chosen]:
+                chosen = client
+        self.current[chosen] -= total
+        return chosen
+
+    def _remove(self, client, future):
+        queue = self.waiters.get(client)
+        if queue is not None and future is not None and future in queue:
+            queue.remove(future)
+        if queue is not None and not queue:
+            del self.waiters[client]
+            self.current.pop(client, None)
+
+class JobQueue:
+    """Run submitted jobs on a fixed number of workers and keep their results"""
+
+    def __init__(self, max_workers=4, max_pending=32, retention=3600, name='job', gateway=None,
+                 max_wait=None, max_pending_per_client=None, weights=None):
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.retention = retention
+        self.name = name
+        self.max_wait = max_wait
+        self.max_pending_per_client = max_pending_per_client
+        self.weights = weights or {}
+        self.gateway = gateway
+        self.slots = None
+        self.jobs = {}
+        self.pending = 0
+        self.running = 0
+        self.queued_by_client = {}
+        self.run_time = None
+        self.shed = {'queue_full': 0, 'client_limit': 0, 'expected_wait': 0, 'deadline': 0}
+        self.wait_times = deque(maxlen=200)
+        self.condition = threading.Condition()
+
+    def submit(self, fn, *args, client=None, **kwargs):
+        """Enqueue coroutine fn(*args, **kwargs) on behalf of `client` and return its job id at once"""
+        with self.condition:
+            self._prune(time.time())
+            queued = self.queued_by_client.get(client, 0)
+            if self.pending >= self.max_pending:
+                self._refuse('queue_full', '服务繁忙，请稍后重试')
+            if self.max_pending_per_client and queued >= self.max_pending_per_client:
+                self._refuse('client_limit', '您的排队任务过多，请等待已提交的任务完成')
+            if self.max_wait and self.run_time and self.running >= self.max_workers:
+                # Shed at the door when this client's next job could not start within max_wait
+                expected = self._jobs_ahead(client, queued + 1) / self.max_workers * self.run_time
+                if expected > self.max_wait:
+                    self._refuse('expected_wait', '服务繁忙，预计排队时间过长，请稍后重试',
+                                 expected - self.max_wait)
+            job_id = str(uuid.uuid4())
+            self.jobs[job_id] = {
+                'state': {'success': True, 'status': 'queued'},
+                'version': 0,
+                'client': client,
+                'created_at': time.time(),
+                'started_at': None,
+                'finished_at': None,
+                'future': None,
+                'callbacks': []
+            }
+            self.pending += 1
+            self.queued_by_client[client] = queued + 1
+        future = self.gateway.submit(self._run_async(job_id, fn, args, kwargs))
+        with self.condition:
+            self.jobs[job_id]['future'] = future
+        future.add_done_callback(lambda f: self._on_done(job_id, f))
+        return job_id
+
+    def add_done_callback(self, job_id, callback):
+        """Call callback(state) once the job finishes, however it ends (at once if it already has)"""
+        with self.condition:
+            job = self.jobs[job_id]
+            if not job['finished_at']:
+                job['callbacks'].append(callback)
+                return
+            state = dict(job['state'])
+        callback(state)
+
+    def cancel(self, job_id):
+        """Cancel a queued or running job; False if it is unknown or already finished"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job['finished_at'] or job['future'] is None:
+                return False
+            future = job['future']
+        return future.cancel()
+
+    def get(self, job_id):
+        """Return the latest state of a job, or None if unknown"""
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None:
+                return None
+            state = dict(job['state'])
+            if state['status'] == 'queued':
+                state['queue_position'] = self._queue_position(job_id)
+            return state
+
+    def wait(self, job_id, version, timeout):
+        """Block until the job moves past `version`; return (version, state)"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                job = self.jobs.get(job_id)
+                if job is None:
+                    return version, None
+                if job['version'] > version:
+                    return job['version'], dict(job['state'])
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return version, dict(job['state'])
+                self.condition.wait(remaining)
+
+    def stats(self):
+        """Queue depth and wait-time statistics"""
+        with self.condition:
+            waits = sorted(self.wait_times)
+            return {
+                'workers': self.max_workers,
+                'max_pending': self.max_pending,
+                'queued': self.pending,
+                'running': self.running,
+                'tracked_jobs': len(self.jobs),
+                'queued_clients': len(self.queued_by_client),
+                'max_wait': self.max_wait,
+                'run_time_avg': round(self.run_time, 3) if self.run_time else 0,
+                'shed': dict(self.shed),
+                'wait_time_avg': round(sum(waits) / len(waits), 3) if waits else 0,
+                'wait_time_p95': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3) if waits else 0,
+                'wait_time_max': round(waits[-1], 3) if waits else 0
+            }
+
+    def shutdown(self):
+        """Stop accepting work; jobs not yet started are cancelled"""
+        with self.condition:
+            futures = [job['future'] for job in self.jobs.values()
+                       if job['future'] and job['state']['status'] == 'queued']
+        for future in futures:
+            future.cancel()
+
+    def _queue_position(self, job_id):
+        client, created_at = self.jobs[job_id]['client'], self.jobs[job_id]['created_at']
+        position = 1 + sum(1 for job in self.jobs.values() if job['client'] == client
+                           and job['state']['status'] == 'queued' and job['created_at'] < created_at)
+        return self._jobs_ahead(client, position)
+
+    def _weight(self, client):
+        return self.weights.get(client, 1)
+
+    def _jobs_ahead(self, client, position):
+        """Jobs started up to and including a client's `position`-th queued job, under round-robin"""
+        weight = self._weight(client)
+        return position + sum(min(queued, math.ceil(position * self._weight(other) / weight))
+                              for other, queued in self.queued_by_client.items() if other != client)
+
+    def _refuse(self, reason, message, retry_after=None):
+        self.shed[reason] += 1
+        metrics.JOB_QUEUE_SHED.inc(queue=self.name, reason=reason)
+        raise QueueFullError(message, retry_after)
+
+    def _dequeue(self, job):
+        self.pending -= 1
+        client = job['client']
+        self.queued_by_client[client] -= 1
+        if not self.queued_by_client[client]:
+            del self.queued_by_client[client]
+
+    def _update(self, job_id, state, **fields):
+        job = self.jobs[job_id]
+        job['state'] = state
+        job['version'] += 1
+        job.update(fields)
+        self.condition.notify_all()
+
+    def _prune(self, now):
+        expired = [job_id for job_id, job in self.jobs.items()
+                   if job['finished_at'] and now - job['finished_at'] > self.retention]
+        for job_id in expired:
+            del self.jobs[job_id]
+
+    def _start(self, job_id):
+        with self.condition:
+            now = time.time()
+            self._dequeue(self.jobs[job_id])
+            self.running += 1
+            wait_time = now - self.jobs[job_id]['created_at']
+            self.wait_times.append(wait_time)
+            metrics.QUEUE_WAIT.observe(wait_time, queue=self.name)
+            self._update(job_id, {'success': True, 'status': 'running'}, started_at=now)
+
+    def _finish(self, job_id, state):
+        with self.condition:
+            job = self.jobs.get(job_id)
+            if job is None or job['finished_at']:
+                return
+            now = time.time()
+            if job['state']['status'] == 'queued':
+                self._dequeue(job)
+            else:
+                self.running -= 1
+                if state.get('error') != '任务已取消':
+                    # Moving average of run time, for estimating queue waits
+                    run_time = now - job['started_at']
+                    self.run_time = run_time if self.run_time is None else 0.8 * self.run_time + 0.2 * run_time
+            self._update(job_id, state, finished_at=now)
+            callbacks, job['callbacks'] = job['callbacks'], []
+        for callback in callbacks:
+            callback(dict(state))
+
+    def _on_done(self, job_id, future):
+        # Jobs cancelled before or while running never reach _finish() themselves
+        if future.cancelled():
+            self._finish(job_id, {'success': False, 'status': 'failed', 'error': '任务已取消'})
+
+    def _expired(self, job_id):
+        """Fail a job that waited past max_wait; its client has likely given up by now"""
+        with self.condition:
+            self.shed['deadline'] += 1
+        metrics.JOB_QUEUE_SHED.inc(queue=self.name, reason='deadline')
+        self._finish(job_id, {'success': False, 'status': 'failed', 'error': '排队超时，请稍后重试'})
+
+    async def _run_async(self, job_id, fn, args, kwargs):
+        if self.slots is None:
+            self.slots = FairSlots(self.max_workers, self._weight)
+        with self.condition:
+            client, created_at = self.jobs[job_id]['client'], self.jobs[job_id]['created_at']
+        try:
+            if self.max_wait:
+                await asyncio.wait_for(self.slots.acquire(client), self.max_wait - (time.time() - created_at))
+            else:
+                await self.slots.acquire(client)
+        except asyncio.TimeoutError:
+            self._expired(job_id)
+            return
+        try:
+            self._start(job_id)
+            try:
+                state = await fn(*args, **kwargs)
+            except Exception as e:
+                state = {'success': False, 'status': 'failed', 'error': f'服务器错误: {str(e)}'}
+            self._finish(job_id, state)
+        finally:
+            self.slots.release()
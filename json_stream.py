@@ -0,0 +1,86 @@
+import base64
+import json
+
+# Incremental JSON encoding for request payloads that embed large images.
+# An image is kept as raw bytes (Base64Data) inside the payload dict and only
+# base64-encoded chunk by chunk while the body is written to the socket, so
+# neither the base64 string nor the serialized body ever exists in full.
+
+CHUNK_SIZE = 64 * 1024
+BASE64_CHUNK = 48 * 1024  # raw bytes per piece; a multiple of 3, so pieces concatenate cleanly
+
+class Base64Data:
+    """Binary data that serializes as a base64 data URI string"""
+
+    def __init__(self, data, mime_type):
+        self.data = data
+        self.mime_type = mime_type
+        self.prefix = f"data:{mime_type};base64,".encode('ascii')
+
+    def __len__(self):
+        # Characters of the encoded data URI, as it appears in the request body
+        return len(self.prefix) + (len(self.data) + 2) // 3 * 4
+
+    def iter_json(self):
+        yield b'"' + self.prefix
+        view = memoryview(self.data)
+        for start in range(0, len(view), BASE64_CHUNK):
+            yield base64.b64encode(view[start:start + BASE64_CHUNK])
+        yield b'"'
+
+    def data_uri(self):
+        """The whole data URI as one string (for small payloads and debugging)"""
+        return b''.join(self.iter_json())[1:-1].decode('ascii')
+
+def contains_binary(value):
+    """Whether a payload holds any Base64Data that should be streamed"""
+    if isinstance(value, Base64Data):
+        return True
+    if isinstance(value, dict):
+        return any(contains_binary(item) for item in value.values())
+    if isinstance(value, (list, tuple)):
+        return any(contains_binary(item) for item in value)
+    return False
+
+def iter_json(value):
+    """UTF-8 JSON encoding of a payload, as a sequence of byte strings"""
+    if isinstance(value, Base64Data):
+        yield from value.iter_json()
+    elif isinstance(value, dict):
+        yield b'{'
+        for index, (key, item) in enumerate(value.items()):
+            yield (', ' if index else '').encode('ascii') + json.dumps(str(key), ensure_ascii=False).encode('utf-8') + b': '
+            yield from iter_json(item)
+        yield b'}'
+    elif isinstance(value, (list, tuple)):
+        yield b'['
+        for index, item in enumerate(value):
+            if index:
+                yield b', '
+            yield from iter_json(item)
+        yield b']'
+    else:
+        yield json.dumps(value, ensure_ascii=False).encode('utf-8')
+
+class JsonStream:
+    """Async iterable request body for a payload; each iteration encodes it afresh (retries)"""
+
+    def __init__(self, payload, chunk_size=CHUNK_SIZE):
+        self.payload = payload
+        self.chunk_size = chunk_size
+
+    def __aiter__(self):
+        return self._chunks()
+
+    async def _chunks(self):
+        pending = []
+        size = 0
+        for piece in iter_json(self.payload):
+            pending.append(piece)
+            size += len(piece)
+            if size >= self.chunk_size:
+                yield b''.join(pending)
+                pending = []
+                size = 0
+        if pending:
+            yield b''.join(pending)
@@ -0,0 +1,162 @@
+import hashlib
+import logging
+import threading
+import time
+from structured_logging import log_event
+
+logger = logging.getLogger(__name__)
+
+# Multi-key API key pool with per-key token buckets and optional concurrency
+# limits. Edit calls hold a key for up to a minute, so they draw from their own
+# slot budget within the key's limit and never take the slots that task
+# submissions and status queries need
+
+def key_id(key):
+    """Stable identifier of an API key that does not reveal it"""
+    return hashlib.sha256(key.encode('utf-8')).hexdigest()[:16]
+
+class NoKeyAvailableError(Exception):
+    """Raised when no API key frees up before the acquire timeout"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class ApiKey:
+    """One API key with its token bucket, concurrency slots and throttle state.
+
+    concurrency=None leaves the key uncapped; a capped key lets edits hold at
+    most edit_concurrency (default half) of its slots.
+    """
+
+    def __init__(self, key, qps=5.0, burst=None, concurrency=None, edit_concurrency=None):
+        self.key = key
+        self.rate = float(qps)
+        self.capacity = float(burst or max(1.0, qps))
+        self.tokens = self.capacity
+        self.concurrency = concurrency
+        if concurrency:
+            edit_concurrency = min(edit_concurrency or max(1, concurrency // 2), concurrency)
+        self.edit_concurrency = edit_concurrency
+        self.in_flight = 0
+        self.edit_in_flight = 0
+        self.sidelined_until = 0.0
+        self.throttle_count = 0
+        self.updated_at = time.monotonic()
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def ready_at(self, now):
+        """Earliest time this key could accept a request (ignoring concurrency)"""
+        if self.sidelined_until > now:
+            return self.sidelined_until
+        if self.tokens >= 1:
+            return now
+        return now + (1 - self.tokens) / self.rate
+
+    def has_slot(self, edit):
+        if self.concurrency and self.in_flight >= self.concurrency:
+            return False
+        return not (edit and self.edit_concurrency and self.edit_in_flight >= self.edit_concurrency)
+
+    def load(self):
+        return self.in_flight / self.concurrency if self.concurrency else 0.0
+
+    def describe(self):
+        return {
+            'key_id': key_id(self.key),
+            'qps': self.rate,
+            'concurrency': self.concurrency,
+            'in_flight': self.in_flight,
+            'edit_concurrency': self.edit_concurrency,
+            'edit_in_flight': self.edit_in_flight,
+            'tokens': round(self.tokens, 2),
+            'sidelined_for': round(max(0.0, self.sidelined_until - time.monotonic()), 1)
+        }
+
+class KeyPool:
+    """Hand out the least-loaded key that has a token and a free concurrency slot"""
+
+    def __init__(self, keys, sideline_seconds=5.0, max_sideline_seconds=60.0):
+        self.keys = keys
+        self.sideline_seconds = sideline_seconds
+        self.max_sideline_seconds = max_sideline_seconds
+        self.lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a pool from api-key.json.
+
+        Accepts the original single-key form {"qwen-api-key": "sk-..."} and a
+        multi-key form {"qwen-api-keys": [{"key": "sk-...", "qps": 5,
+        "concurrency": 8, "edit_concurrency": 4}, ...]}; keys without a
+        "concurrency" are uncapped.
+        """
+        entries = config.get('qwen-api-keys') or []
+        keys = [ApiKey(
+            entry['key'],
+            qps=entry.get('qps', 5.0),
+            burst=entry.get('burst'),
+            concurrency=entry.get('concurrency'),
+            edit_concurrency=entry.get('edit_concurrency')
+        ) for entry in entries if entry.get('key')]
+        if not keys and config.get('qwen-api-key'):
+            keys = [ApiKey(config['qwen-api-key'])]
+        return cls(keys)
+
+    def __len__(self):
+        return len(self.keys)
+
+    def edit_capacity(self):
+        """Edit calls the pool can run at once, or None if some key is uncapped"""
+        if not self.keys or any(k.edit_concurrency is None for k in self.keys):
+            return None
+        return sum(k.edit_concurrency for k in self.keys)
+
+    def try_acquire(self, preferred=None, edit=False):
+        """Reserve a key without blocking; returns (key, None) or (None, seconds to retry after)"""
+        if not self.keys:
+            raise NoKeyAvailableError('未配置API Key')
+        with self.lock:
+            now = time.monotonic()
+            candidates = [k for k in self.keys if preferred is None or k.key == preferred]
+            if not candidates:
+                # Pinned key no longer configured; fall back to any key
+                candidates = self.keys
+            for k in candidates:
+                k.refill(now)
+            ready = [k for k in candidates if k.has_slot(edit) and k.ready_at(now) <= now]
+            if ready:
+                chosen = min(ready, key=lambda k: (k.load(), -k.tokens))
+                chosen.tokens -= 1
+                chosen.in_flight += 1
+                if edit:
+                    chosen.edit_in_flight += 1
+                return chosen, None
+            next_ready = min(k.ready_at(now) for k in candidates) - now
+            return None, max(0.01, next_ready)
+
+    def release(self, api_key, throttled=False, retry_after=None, edit=False):
+        """Return a key; a throttled key is sidelined with exponential backoff"""
+        with self.lock:
+            api_key.in_flight -= 1
+            if edit:
+                api_key.edit_in_flight -= 1
+            if throttled:
+                api_key.throttle_count += 1
+                backoff = retry_after or min(
+                    self.max_sideline_seconds,
+                    self.sideline_seconds * (2 ** (api_key.throttle_count - 1))
+                )
+                api_key.sidelined_until = time.monotonic() + backoff
+                log_event(logger, logging.WARNING, 'api_key_throttled',
+                          key_id=key_id(api_key.key), sideline_seconds=round(backoff, 1))
+            else:
+                api_key.throttle_count = 0
+
+    def stats(self):
+        """Per-key load and throttle state; keys appear only as key_id()"""
+        with self.lock:
+            return [k.describe() for k in self.keys]
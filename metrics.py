@@ -0,0 +1,111 @@
+import bisect
+import threading
+
+# Minimal Prometheus-style metrics: counters and histograms with labels,
+# rendered in the text exposition format by render()
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+SIZE_BUCKETS = tuple(2 ** p * 1024 for p in range(4, 16, 2))  # 16KB .. 16MB
+
+REGISTRY = []
+
+def format_labels(names, values, extra=None):
+    pairs = list(zip(names, values)) + (extra or [])
+    if not pairs:
+        return ''
+    escaped = [(k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in pairs]
+    return '{' + ','.join(f'{k}="{v}"' for k, v in escaped) + '}'
+
+def format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonically increasing count per label set"""
+
+    kind = 'counter'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        for key, value in items:
+            yield f"{self.name}_total{format_labels(self.labelnames, key)} {format_value(value)}"
+
+class Histogram:
+    """Cumulative bucket counts, sum and count per label set"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self.lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = {'counts': [0] * (len(self.buckets) + 1), 'sum': 0.0}
+            entry['counts'][index] += 1
+            entry['sum'] += value
+
+    def samples(self):
+        with self.lock:
+            items = sorted((key, list(entry['counts']), entry['sum']) for key, entry in self.values.items())
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, [('le', format_value(bound))])
+                yield f"{self.name}_bucket{labels} {cumulative}"
+            yield f"{self.name}_sum{format_labels(self.labelnames, key)} {format_value(total)}"
+            yield f"{self.name}_count{format_labels(self.labelnames, key)} {cumulative}"
+
+def render():
+    """All registered metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {metric.kind}")
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
+
+UPSTREAM_LATENCY = Histogram(
+    'upstream_request_duration_seconds', 'DashScope request latency by endpoint', ['endpoint'])
+UPSTREAM_RESPONSES = Counter(
+    'upstream_responses', 'DashScope responses by endpoint and HTTP status (or error class)', ['endpoint', 'status'])
+PREPROCESS_DURATION = Histogram(
+    'preprocess_duration_seconds', 'Edit upload preprocessing time by stage', ['stage'])
+PAYLOAD_SIZE = Histogram(
+    'edit_payload_base64_bytes', 'Size of the base64 data URI sent for edits', buckets=SIZE_BUCKETS)
+QUEUE_WAIT = Histogram(
+    'job_queue_wait_seconds', 'Time jobs spend queued before a worker picks them up', ['queue'])
+TASK_COMPLETION = Histogram(
+    'task_time_to_complete_seconds', 'Time from tracking a generation task to its terminal state', ['status'],
+    buckets=(1, 2.5, 5, 10, 15, 20, 30, 45, 60, 90, 120, 300))
+TASK_STATUS_LOOKUPS = Counter(
+    'task_status_lookups', 'Task status cache lookups by result (hit, miss, coalesced)', ['result'])
+UPSTREAM_CIRCUIT = Counter(
+    'upstream_circuit_transitions', 'Circuit breaker state changes by endpoint and new state', ['endpoint', 'state'])
+JOB_QUEUE_SHED = Counter(
+    'job_queue_shed', 'Jobs refused or dropped to bound queue wait, by reason', ['queue', 'reason'])
@@ -0,0 +1,133 @@
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image, ImageOps
+from image_pipeline import apply_draft
+
+# Downscaled WebP/JPEG previews of stored uploads and results for the pages'
+# preview panes. Sources are content-addressed, so a preview is keyed by the
+# source digest, width and format, rendered once and then served from disk.
+
+PREVIEW_WIDTHS = (256, 512, 1024)
+PREVIEW_FORMATS = {'webp': ('WEBP', 'image/webp'), 'jpg': ('JPEG', 'image/jpeg')}
+
+def render_preview(source_path, target_path, width, fmt):
+    """Write a preview of source_path at most `width` pixels wide (runs in a pool worker)"""
+    with Image.open(source_path) as img:
+        scale = width / img.width
+        apply_draft(img, scale)
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'RGBA', 'L'):
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+        if img.width > width:
+            img = img.resize((width, max(1, round(img.height * width / img.width))),
+                             Image.Resampling.LANCZOS, reducing_gap=2.0)
+        if fmt == 'jpg':
+            if img.mode == 'RGBA':
+                # JPEG has no alpha: flatten onto white like the edit pipeline does
+                canvas = Image.new('RGB', img.size, 'white')
+                canvas.paste(img, mask=img.getchannel('A'))
+                img = canvas
+            options = {'quality': 82, 'optimize': True, 'progressive': True}
+        else:
+            options = {'quality': 80, 'method': 4}
+        tmp_path = os.path.join(os.path.dirname(target_path), f".{uuid.uuid4()}.tmp")
+        try:
+            img.save(tmp_path, PREVIEW_FORMATS[fmt][0], **options)
+            os.replace(tmp_path, target_path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    return os.path.getsize(target_path)
+
+class PreviewStore:
+    """Render previews off the request thread, once per (source, width, format), with a disk bound"""
+
+    def __init__(self, directory, max_bytes=256 * 1024 * 1024, pool=None, workers=2,
+                 timeout=30, evict_interval=60):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.pool = pool
+        self.timeout = timeout
+        self.evict_interval = evict_interval
+        self.last_evict = 0.0
+        self.in_flight = {}
+        self.counts = {'hit': 0, 'rendered': 0, 'coalesced': 0}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='preview')
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, source_path, source_name, width, fmt):
+        """Path of the preview for a stored source file, rendering it on first request"""
+        digest = source_name.rsplit('.', 1)[0]
+        target_path = os.path.join(self.directory, f"{digest}_{width}.{fmt}")
+        if os.path.exists(target_path):
+            self._count('hit')
+            try:
+                # mtime doubles as the last-use time for eviction
+                os.utime(target_path)
+            except OSError:
+                pass
+            return target_path
+
+        with self.lock:
+            future = self.in_flight.get(target_path)
+            if future is None:
+                self.counts['rendered'] += 1
+                future = self.in_flight[target_path] = self.executor.submit(
+                    self._render, source_path, target_path, width, fmt)
+                future.add_done_callback(lambda f: self._rendered(target_path))
+            else:
+                self.counts['coalesced'] += 1
+        future.result(self.timeout)
+        return target_path
+
+    def stats(self):
+        with self.lock:
+            return {**self.counts, 'in_flight': len(self.in_flight), 'max_bytes': self.max_bytes}
+
+    def _render(self, source_path, target_path, width, fmt):
+        # With a process pool the decode and resize also stay off this process's GIL
+        if self.pool is not None:
+            return self.pool.run(render_preview, source_path, target_path, width, fmt)
+        return render_preview(source_path, target_path, width, fmt)
+
+    def _rendered(self, target_path):
+        with self.lock:
+            self.in_flight.pop(target_path, None)
+            # Scanning the directory is O(files), so only do it periodically
+            evict = time.time() - self.last_evict >= self.evict_interval
+            if evict:
+                self.last_evict = time.time()
+        if evict:
+            self._evict()
+
+    def _count(self, result):
+        with self.lock:
+            self.counts[result] += 1
+
+    def _evict(self):
+        """Delete the least recently used previews until under max_bytes"""
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
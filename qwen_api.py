@@ -0,0 +1,78 @@
+# Request payloads and response parsing for the Qwen image APIs, shared by
+# the web app (app.py) and the offline batch runner (batch_runner.py)
+
+def generation_payload(data):
+    """Build the qwen-image request for a generation job; returns (payload, error message)"""
+    prompt = data.get('prompt', '')
+    if not prompt:
+        return None, '请输入图像描述'
+    try:
+        n = int(data.get('n', 1))
+    except (TypeError, ValueError):
+        return None, '生成数量必须是整数'
+
+    payload = {
+        "model": "qwen-image",
+        "input": {
+            "prompt": prompt
+        },
+        "parameters": {
+            "size": data.get('size', '1328*1328'),
+            "n": min(max(n, 1), 4),
+            "prompt_extend": data.get('prompt_extend', True),
+            "watermark": data.get('watermark', False)
+        }
+    }
+
+    # Add negative prompt if provided
+    negative_prompt = data.get('negative_prompt', '')
+    if negative_prompt:
+        payload["input"]["negative_prompt"] = negative_prompt
+    return payload, None
+
+def edit_payload(image, edit_prompt):
+    """Build the qwen-image-edit request; `image` is a json_stream.Base64Data or a URL"""
+    return {
+        "model": "qwen-image-edit",
+        "input": {
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "image": image
+                        },
+                        {
+                            "text": edit_prompt
+                        }
+                    ]
+                }
+            ]
+        },
+        "parameters": {
+            "negative_prompt": "",
+            "watermark": False
+        }
+    }
+
+def task_result(result):
+    """(status, image URLs, error) of a generation task response; status is completed, failed or processing"""
+    output = result.get('output', {})
+    if output.get('task_status') == 'SUCCEEDED':
+        return 'completed', [r['url'] for r in output.get('results', []) if r.get('url')], None
+    if output.get('task_status') == 'FAILED':
+        return 'failed', [], output.get('message', '任务失败')
+    if output.get('task_status') == 'UNKNOWN':
+        # DashScope's answer for ids it does not know: malformed, expired, or owned by another key
+        return 'failed', [], '任务不存在或已过期'
+    return 'processing', [], None
+
+def edit_result_url(result):
+    """URL of the edited image in a qwen-image-edit response, or None"""
+    for choice in result.get('output', {}).get('choices', [])[:1]:
+        content = choice.get('message', {}).get('content')
+        if isinstance(content, list):
+            for item in content:
+                if isinstance(item, dict) and 'image' in item:
+                    return item['image']
+    return None
@@ -0,0 +1,140 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Content-addressed cache of generation/edit results: memory LRU tier + on-disk tier
+
+def make_key(model, params, image_digest=None):
+    """Normalized hash of the model, every request parameter and the input image digest"""
+    normalized = {
+        'model': model,
+        'params': {k: v for k, v in params.items() if v not in (None, '')},
+        'image': image_digest
+    }
+    encoded = json.dumps(normalized, sort_keys=True, ensure_ascii=False, separators=(',', ':'))
+    return hashlib.sha256(encoded.encode('utf-8')).hexdigest()
+
+class ResultCache:
+    """Two-tier TTL cache; memory is bounded by entry count, disk by total bytes"""
+
+    def __init__(self, directory, memory_items=256, disk_max_bytes=64 * 1024 * 1024, ttl=12 * 3600,
+                 evict_interval=60):
+        self.directory = directory
+        self.memory_items = memory_items
+        self.disk_max_bytes = disk_max_bytes
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+        self.last_evict = 0
+        self.memory = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self, key):
+        """Return the cached value for key, or None if missing or expired"""
+        now = time.time()
+        with self.lock:
+            entry = self.memory.get(key)
+            if entry is not None:
+                if now - entry['created_at'] < self.ttl:
+                    self.memory.move_to_end(key)
+                    self.hits += 1
+                    return entry['value']
+                del self.memory[key]
+
+        entry = self._read_disk(key)
+        with self.lock:
+            if entry is None or now - entry['created_at'] >= self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(key, entry)
+            return entry['value']
+
+    def set(self, key, value):
+        """Store value in both tiers"""
+        entry = {'created_at': time.time(), 'value': value}
+        with self.lock:
+            self._remember(key, entry)
+        self._write_disk(key, entry)
+
+    def stats(self):
+        """Hit/miss counters and memory tier size"""
+        with self.lock:
+            return {
+                'memory_entries': len(self.memory),
+                'hits': self.hits,
+                'misses': self.misses
+            }
+
+    def _remember(self, key, entry):
+        self.memory[key] = entry
+        self.memory.move_to_end(key)
+        while len(self.memory) > self.memory_items:
+            self.memory.popitem(last=False)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def _read_disk(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if time.time() - entry['created_at'] >= self.ttl:
+            self._remove(path)
+            return None
+        # Refresh mtime so disk eviction is least-recently-used
+        os.utime(path)
+        return entry
+
+    def _write_disk(self, key, entry):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+        # Scanning the directory is O(files), so only do it periodically
+        if time.time() - self.last_evict >= self.evict_interval:
+            self.last_evict = time.time()
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """Drop expired files, then least-recently-used ones until under the size bound"""
+        now = time.time()
+        files = []
+        total = 0
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                if now - stat.st_mtime >= self.ttl:
+                    self._remove(path)
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        files.sort()
+        for _, size, path in files:
+            if total <= self.disk_max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,153 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+import upstream
+from structured_logging import log_event
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed local mirror of result images (DashScope OSS URLs expire).
+# The directory is kept under a disk quota: files unused for max_age are
+# deleted, then the least recently used until it fits. As with previews,
+# mtime records the last use, so every worker process sees the same order
+
+CONTENT_TYPE_EXTENSIONS = {
+    'image/png': 'png',
+    'image/jpeg': 'jpg',
+    'image/webp': 'webp',
+    'image/gif': 'gif',
+    'image/bmp': 'bmp'
+}
+
+class ResultStore:
+    """Download result images once and store them under their SHA-256 digest"""
+
+    def __init__(self, directory, url_prefix, max_bytes=50 * 1024 * 1024, timeout=(5, 60),
+                 quota_bytes=2 * 1024 * 1024 * 1024, max_age=30 * 24 * 3600, evict_interval=60):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.max_bytes = max_bytes
+        self.timeout = timeout
+        self.quota_bytes = quota_bytes
+        self.max_age = max_age
+        self.evict_interval = evict_interval
+        self.last_evict = 0.0
+        self.mirrored = {}
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def mirror(self, url):
+        """Fetch url into the store and return its stable local URL"""
+        with self.lock:
+            filename = self.mirrored.get(url)
+        if filename and self._touch(os.path.join(self.directory, filename)):
+            return self.local_url(filename)
+
+        digest = hashlib.sha256()
+        tmp_path = os.path.join(self.directory, f".{uuid.uuid4()}.tmp")
+        try:
+            with upstream.session.get(url, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                content_type = response.headers.get('Content-Type', '').split(';')[0].strip()
+                ext = CONTENT_TYPE_EXTENSIONS.get(content_type, 'png')
+                size = 0
+                with open(tmp_path, 'wb') as f:
+                    for chunk in response.iter_content(chunk_size=64 * 1024):
+                        size += len(chunk)
+                        if size > self.max_bytes:
+                            raise Exception('结果图像过大')
+                        digest.update(chunk)
+                        f.write(chunk)
+
+            filename = f"{digest.hexdigest()}.{ext}"
+            path = os.path.join(self.directory, filename)
+            if self._touch(path):
+                # Same bytes already stored
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+        with self.lock:
+            self.mirrored[url] = filename
+            if len(self.mirrored) > 4096:
+                self.mirrored.pop(next(iter(self.mirrored)))
+            # Scanning the directory is O(files), so only do it periodically
+            evict = time.time() - self.last_evict >= self.evict_interval
+            if evict:
+                self.last_evict = time.time()
+        if evict:
+            self.evict()
+        return self.local_url(filename)
+
+    def mirror_or_original(self, url):
+        """Mirror url, falling back to the remote URL if the download fails"""
+        try:
+            return self.mirror(url)
+        except Exception as e:
+            log_event(logger, logging.WARNING, 'result_mirror_failed', url=url, error=str(e))
+            return url
+
+    def local_url(self, filename):
+        """URL under which the app serves a stored file"""
+        return f"{self.url_prefix}/{filename}"
+
+    def filename(self, url):
+        """Stored file name behind one of our local URLs, or None for any other URL"""
+        prefix = f"{self.url_prefix}/"
+        return url[len(prefix):] if url.startswith(prefix) else None
+
+    def path(self, filename):
+        """Absolute path of a stored file (marking it used), or None"""
+        path = os.path.join(self.directory, filename)
+        if filename.startswith('.') or os.path.basename(filename) != filename or not self._touch(path):
+            return None
+        return path
+
+    def available(self, url):
+        """False for one of our local URLs whose file has been evicted"""
+        filename = self.filename(url)
+        return filename is None or self.path(filename) is not None
+
+    def evict(self):
+        """Delete files unused for max_age, then the least recently used until under quota"""
+        files = []
+        total = 0
+        for entry in os.scandir(self.directory):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+            total += stat.st_size
+
+        files.sort()
+        expire_before = time.time() - self.max_age
+        removed = 0
+        for mtime, size, path in files:
+            if total <= self.quota_bytes and mtime >= expire_before:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+        if removed:
+            log_event(logger, logging.INFO, 'results_evicted', files=removed, total_bytes=total)
+        return removed
+
+    def _touch(self, path):
+        # mtime doubles as the last-use time for eviction; False if the file is gone
+        try:
+            os.utime(path)
+            return os.path.isfile(path)
+        except OSError:
+            return False
@@ -0,0 +1,90 @@
+"""Production entry point: run app.py's `app` under a production WSGI server.
+
+On Linux/macOS this uses gunicorn with one threaded (gthread) worker,
+which calls app.init_worker() after forking and app.shutdown_worker() on
+exit. On Windows, where gunicorn cannot run, it falls back to waitress
+(a single process with a thread pool).
+
+    python serve.py --threads 64
+    SERVE_THREADS=64 python serve.py
+
+There is deliberately a single worker process: edit jobs, batches, `job:`
+image handles, tracked tasks and the key pool's limits live in its memory,
+and a follow-up request (/jobs/<id>, an SSE stream) must reach the process
+that knows the job. It still uses several cores: upstream calls run on
+the asyncio gateway without holding threads, and image decoding and
+resizing run in the IMAGE_POOL_WORKERS process pool. Status streams are
+closed after SSE_MAX_SECONDS, so open tabs cannot hold every thread.
+"""
+import argparse
+import os
+import sys
+
+def env_int(name, default):
+    return int(os.environ.get(name, default))
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the image service with a production WSGI server')
+    parser.add_argument('--host', default=os.environ.get('SERVE_HOST', '0.0.0.0'))
+    parser.add_argument('--port', type=int, default=env_int('SERVE_PORT', 5004))
+    parser.add_argument('--threads', type=int, default=env_int('SERVE_THREADS', 64),
+                        help='request threads; an SSE stream holds one for up to SSE_MAX_SECONDS')
+    parser.add_argument('--keepalive', type=int, default=env_int('SERVE_KEEPALIVE', 5),
+                        help='seconds to keep idle client connections open')
+    parser.add_argument('--timeout', type=int, default=env_int('SERVE_TIMEOUT', 120),
+                        help='seconds before a silent worker is restarted')
+    parser.add_argument('--graceful-timeout', type=int, default=env_int('SERVE_GRACEFUL_TIMEOUT', 30),
+                        help='seconds workers get to finish in-flight requests on shutdown')
+    parser.add_argument('--preload', action='store_true', default=os.environ.get('SERVE_PRELOAD') == '1',
+                        help='import the app once in the master before forking')
+    return parser.parse_args()
+
+def run_gunicorn(args):
+    from gunicorn.app.base import BaseApplication
+
+    def post_worker_init(worker):
+        import app as app_module
+        app_module.init_worker()
+
+    def worker_exit(server, worker):
+        import app as app_module
+        app_module.shutdown_worker()
+
+    class StandaloneApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set('bind', f"{args.host}:{args.port}")
+            self.cfg.set('workers', 1)
+            self.cfg.set('worker_class', 'gthread')
+            self.cfg.set('threads', args.threads)
+            self.cfg.set('keepalive', args.keepalive)
+            self.cfg.set('timeout', args.timeout)
+            self.cfg.set('graceful_timeout', args.graceful_timeout)
+            self.cfg.set('preload_app', args.preload)
+            self.cfg.set('post_worker_init', post_worker_init)
+            self.cfg.set('worker_exit', worker_exit)
+            self.cfg.set('accesslog', '-')
+
+        def load(self):
+            from app import app
+            return app
+
+    StandaloneApplication().run()
+
+def run_waitress(args):
+    from waitress import serve
+    import app as app_module
+
+    app_module.init_worker()
+    try:
+        serve(app_module.app, host=args.host, port=args.port, threads=args.threads,
+              channel_timeout=args.timeout, connection_limit=max(100, args.threads * 4))
+    finally:
+        app_module.shutdown_worker()
+
+if __name__ == '__main__':
+    args = parse_args()
+    print(f"🚀 生产模式启动: http://{args.host}:{args.port} (threads={args.threads})")
+    if sys.platform == 'win32':
+        run_waitress(args)
+    else:
+        run_gunicorn(args)
@@ -0,0 +1,86 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+import metrics
+from task_tracker import TERMINAL_STATUSES
+
+# In-process cache of task states in front of the DashScope task query.
+# Terminal states never change, so they stay until evicted (LRU); in-progress
+# states expire after a short TTL. Concurrent lookups of one task id share a
+# single upstream request.
+
+class StatusCache:
+    """Cache task states and coalesce concurrent lookups into one upstream query"""
+
+    def __init__(self, fetch_status, processing_ttl=1.0, max_entries=10000):
+        self.fetch_status = fetch_status
+        self.processing_ttl = processing_ttl
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.in_flight = {}
+        self.counts = {'hit': 0, 'miss': 0, 'coalesced': 0}
+        self.lock = threading.Lock()
+
+    def peek(self, task_id):
+        """Return the cached state if it is still fresh, else None"""
+        with self.lock:
+            entry = self.entries.get(task_id)
+            if entry is None:
+                return None
+            state, stored_at = entry
+            if state['status'] in TERMINAL_STATUSES:
+                self.entries.move_to_end(task_id)
+                return dict(state)
+            if time.monotonic() - stored_at < self.processing_ttl:
+                return dict(state)
+            return None
+
+    def put(self, task_id, state):
+        with self.lock:
+            self.entries[task_id] = (dict(state), time.monotonic())
+            self.entries.move_to_end(task_id)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    async def get(self, task_id):
+        """Cached state, or the result of one shared upstream lookup (runs on the gateway loop)"""
+        state = self.peek(task_id)
+        if state is not None:
+            self._count('hit')
+            return state
+        task = self.in_flight.get(task_id)
+        if task is None:
+            self._count('miss')
+            task = self.in_flight[task_id] = asyncio.ensure_future(self._fetch(task_id))
+            task.add_done_callback(lambda t: self._fetched(task_id, t))
+        else:
+            self._count('coalesced')
+        # Shielded so one caller giving up does not cancel the lookup for the others
+        return dict(await asyncio.shield(task))
+
+    def stats(self):
+        with self.lock:
+            lookups = sum(self.counts.values())
+            return {
+                **self.counts,
+                'entries': len(self.entries),
+                'in_flight': len(self.in_flight),
+                'upstream_saved_ratio': round(1 - self.counts['miss'] / lookups, 3) if lookups else 0
+            }
+
+    def _count(self, result):
+        with self.lock:
+            self.counts[result] += 1
+        metrics.TASK_STATUS_LOOKUPS.inc(result=result)
+
+    async def _fetch(self, task_id):
+        state = await self.fetch_status(task_id)
+        self.put(task_id, state)
+        return state
+
+    def _fetched(self, task_id, task):
+        self.in_flight.pop(task_id, None)
+        if not task.cancelled():
+            # Mark the exception retrieved even if every waiter went away
+            task.exception()
@@ -0,0 +1,45 @@
+import json
+import logging
+import time
+
+# Leveled structured logging: each record is an event name plus key/value fields
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname,
+            'logger': record.name,
+            'event': record.getMessage()
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+class KeyValueFormatter(logging.Formatter):
+    """Human-readable `time level event key=value ...` lines"""
+
+    def format(self, record):
+        fields = ' '.join(f"{k}={v}" for k, v in getattr(record, 'fields', {}).items())
+        timestamp = time.strftime('%H:%M:%S', time.localtime(record.created))
+        line = f"{timestamp} {record.levelname} {record.name} {record.getMessage()} {fields}".rstrip()
+        if record.exc_info:
+            line += '\n' + self.formatException(record.exc_info)
+        return line
+
+def configure_logging(level='INFO', fmt='text'):
+    """Install a single stderr handler on the root logger; level OFF silences everything"""
+    handler = logging.StreamHandler()
+    handler.setFormatter(JsonFormatter() if fmt == 'json' else KeyValueFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    level = level.upper()
+    root.setLevel(logging.CRITICAL + 1 if level == 'OFF' else getattr(logging, level, logging.INFO))
+
+def log_event(logger, level, event, **fields):
+    """Log an event with structured fields; fields are only built into a record if enabled"""
+    if logger.isEnabledFor(level):
+        logger.log(level, event, extra={'fields': fields})
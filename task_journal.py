@@ -0,0 +1,237 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from task_tracker import TERMINAL_STATUSES
+from structured_logging import log_event
+
+logger = logging.getLogger(__name__)
+
+# Durable record of every generation task submitted to DashScope, in SQLite
+# so that all worker processes share it. A process owns the tasks it tracks
+# through a lease it keeps renewing; tasks whose lease ran out (their process
+# exited, e.g. before a restart) are claimed by another process and tracked
+# to completion. Owners are random per-process ids rather than pids, which a
+# restarted container hands out again. Finished tasks form the searchable
+# generation history.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tasks (
+    task_id TEXT PRIMARY KEY,
+    prompt TEXT NOT NULL,
+    params TEXT NOT NULL,
+    cache_key TEXT,
+    status TEXT NOT NULL,
+    error TEXT,
+    image_urls TEXT,
+    submitted_at REAL NOT NULL,
+    finished_at REAL,
+    owner TEXT,
+    lease_until REAL,
+    api_key_id TEXT
+);
+CREATE INDEX IF NOT EXISTS tasks_by_time ON tasks (submitted_at);
+CREATE INDEX IF NOT EXISTS tasks_by_status ON tasks (status, submitted_at);
+"""
+
+# Trigram index for substring search in prompts (word tokenizers do not split Chinese)
+FTS_SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS tasks_fts USING fts5(
+    prompt, content='tasks', content_rowid='rowid', tokenize='trigram');
+CREATE TRIGGER IF NOT EXISTS tasks_fts_insert AFTER INSERT ON tasks BEGIN
+    INSERT INTO tasks_fts (rowid, prompt) VALUES (new.rowid, new.prompt);
+END;
+CREATE TRIGGER IF NOT EXISTS tasks_fts_delete AFTER DELETE ON tasks BEGIN
+    INSERT INTO tasks_fts (tasks_fts, rowid, prompt) VALUES ('delete', old.rowid, old.prompt);
+END;
+"""
+
+class TaskJournal:
+    """SQLite journal of generation tasks: submissions, outcomes and history queries"""
+
+    def __init__(self, path, retention=30 * 24 * 3600, lease=60):
+        self.path = path
+        self.retention = retention
+        self.lease = lease
+        self.local = threading.local()
+        self._owner_pid_seen = None
+        self.heartbeat = None
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = self._db()
+        db.executescript(SCHEMA)
+        try:
+            db.executescript(FTS_SCHEMA)
+            self.fts = True
+        except sqlite3.OperationalError:
+            # SQLite built without FTS5 (or older than 3.34): prompt search scans instead
+            self.fts = False
+
+    @property
+    def owner(self):
+        """Random id of this process, regenerated after a fork"""
+        if self._owner_pid_seen != os.getpid():
+            self.owner_id = uuid.uuid4().hex
+            self._owner_pid_seen = os.getpid()
+        return self.owner_id
+
+    def record_submission(self, task_id, prompt, params, cache_key=None, state=None, api_key_id=None):
+        """Journal a newly submitted task, owned (tracked) by this process.
+
+        api_key_id identifies the key that submitted it (see
+        upstream.task_owner_id), so a process resuming it queries with that key.
+        """
+        state = state or {'status': 'processing'}
+        now = time.time()
+        self._db().execute(
+            'INSERT OR IGNORE INTO tasks (task_id, prompt, params, cache_key, status, error, image_urls,'
+            ' submitted_at, finished_at, owner, lease_until, api_key_id) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+            (task_id, prompt, json.dumps(params, ensure_ascii=False), cache_key, state['status'],
+             state.get('error'), json.dumps(state['image_urls']) if state.get('image_urls') else None,
+             now, now if state['status'] in TERMINAL_STATUSES else None, self.owner, now + self.lease, api_key_id)
+        )
+
+    def record_state(self, task_id, state):
+        """Store a task's final state; non-terminal states are not journaled"""
+        if state['status'] not in TERMINAL_STATUSES:
+            return
+        self._db().execute(
+            "UPDATE tasks SET status = ?, error = ?, image_urls = ?, finished_at = ?"
+            " WHERE task_id = ? AND status = 'processing'",
+            (state['status'], state.get('error'),
+             json.dumps(state['image_urls']) if state.get('image_urls') else None, time.time(), task_id)
+        )
+
+    def claim_pending(self, max_age=24 * 3600):
+        """Take over unfinished tasks whose owner's lease ran out; returns [(task_id, cache_key, api_key_id)].
+
+        Tasks older than max_age (DashScope keeps task results for 24 hours)
+        are marked failed instead, and rows past the retention are deleted.
+        """
+        now = time.time()
+        db = self._db()
+        db.execute('BEGIN IMMEDIATE')
+        try:
+            db.execute('DELETE FROM tasks WHERE submitted_at < ?', (now - self.retention,))
+            db.execute(
+                "UPDATE tasks SET status = 'failed', error = ?, finished_at = ?"
+                " WHERE status = 'processing' AND submitted_at < ?",
+                ('任务已过期，结果无法恢复', now, now - max_age)
+            )
+            claimed = db.execute(
+                "SELECT task_id, cache_key, api_key_id FROM tasks WHERE status = 'processing'"
+                " AND (owner IS NULL OR lease_until IS NULL OR lease_until < ?)", (now,)).fetchall()
+            db.executemany('UPDATE tasks SET owner = ?, lease_until = ? WHERE task_id = ?',
+                           [(self.owner, now + self.lease, row['task_id']) for row in claimed])
+            db.execute('COMMIT')
+        except BaseException:
+            db.execute('ROLLBACK')
+            raise
+        return [(row['task_id'], row['cache_key'], row['api_key_id']) for row in claimed]
+
+    def renew_leases(self):
+        """Extend the lease on every unfinished task this process owns"""
+        self._db().execute(
+            "UPDATE tasks SET lease_until = ? WHERE owner = ? AND status = 'processing'",
+            (time.time() + self.lease, self.owner)
+        )
+
+    def start_heartbeat(self, on_claimed):
+        """Renew this process's leases and claim orphaned tasks every lease/3 seconds, in a daemon thread.
+
+        on_claimed(rows) receives what claim_pending() returned; it is also
+        called once right away, so tasks of an exited process are resumed
+        as soon as their lease runs out rather than only at startup.
+        """
+        if self.heartbeat is not None and self.heartbeat.is_alive():
+            return
+        self.heartbeat = threading.Thread(target=self._heartbeat, args=(on_claimed,),
+                                          name='task-journal', daemon=True)
+        self.heartbeat.start()
+
+    def get(self, task_id):
+        row = self._db().execute('SELECT rowid, * FROM tasks WHERE task_id = ?', (task_id,)).fetchone()
+        return self._item(row) if row else None
+
+    def history(self, status=None, query=None, since=None, until=None, cursor=None, limit=20):
+        """Newest-first page of tasks; returns (items, next_cursor or None).
+
+        The cursor is the (submitted_at, rowid) of the last row, so pages stay
+        index range scans however deep the client pages.
+        """
+        clauses, args = [], []
+        if status:
+            clauses.append('status = ?')
+            args.append(status)
+        if since is not None:
+            clauses.append('submitted_at >= ?')
+            args.append(since)
+        if until is not None:
+            clauses.append('submitted_at < ?')
+            args.append(until)
+        if query:
+            if self.fts and len(query) >= 3:
+                clauses.append('rowid IN (SELECT rowid FROM tasks_fts WHERE tasks_fts MATCH ?)')
+                args.append('"' + query.replace('"', '""') + '"')
+            else:
+                clauses.append("prompt LIKE ? ESCAPE '\\'")
+                args.append('%' + query.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%')
+        if cursor:
+            submitted_at, rowid = cursor.split('_', 1)
+            clauses.append('(submitted_at, rowid) < (?, ?)')
+            args.extend([float(submitted_at), int(rowid)])
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ''
+        rows = self._db().execute(
+            f'SELECT rowid, * FROM tasks {where} ORDER BY submitted_at DESC, rowid DESC LIMIT ?',
+            (*args, limit + 1)
+        ).fetchall()
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = f"{rows[-1]['submitted_at']!r}_{rows[-1]['rowid']}"
+        return [self._item(row) for row in rows], next_cursor
+
+    def stats(self):
+        rows = self._db().execute('SELECT status, COUNT(*) AS count FROM tasks GROUP BY status').fetchall()
+        return {row['status']: row['count'] for row in rows}
+
+    def _item(self, row):
+        finished_at = row['finished_at']
+        return {
+            'task_id': row['task_id'],
+            'prompt': row['prompt'],
+            'params': json.loads(row['params']),
+            'status': row['status'],
+            'error': row['error'],
+            'image_urls': json.loads(row['image_urls']) if row['image_urls'] else [],
+            'submitted_at': row['submitted_at'],
+            'finished_at': finished_at,
+            'duration': round(finished_at - row['submitted_at'], 2) if finished_at else None
+        }
+
+    def _heartbeat(self, on_claimed):
+        while True:
+            try:
+                self.renew_leases()
+                claimed = self.claim_pending()
+                if claimed:
+                    on_claimed(claimed)
+            except Exception as e:
+                log_event(logger, logging.ERROR, 'task_journal_failed', error=str(e))
+            time.sleep(self.lease / 3)
+
+    def _db(self):
+        # One autocommit connection per thread, reopened after a fork
+        db = getattr(self.local, 'db', None)
+        if db is None or self.local.pid != os.getpid():
+            db = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            db.row_factory = sqlite3.Row
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            self.local.db = db
+            self.local.pid = os.getpid()
+        return db
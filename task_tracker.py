@@ -0,0 +1,154 @@
+import asyncio
+import threading
+import time
+import logging
+import metrics
+from structured_logging import log_event
+
+logger = logging.getLogger(__name__)
+
+# Background tracker that owns every in-flight DashScope task id. fetch_status
+# is a coroutine function run on the gateway loop, with a whole batch polled concurrently.
+# Tasks are given up on (marked failed) after max_age, or after max_failures
+# polls in a row that returned no state, so no id is polled forever
+
+TERMINAL_STATUSES = ('completed', 'failed')
+
+class TaskTracker:
+    """Poll tracked tasks in batches and notify waiters when their state changes"""
+
+    def __init__(self, fetch_status, min_interval=1.0, max_interval=10.0,
+                 backoff=1.5, batch_size=8, retention=3600, on_change=None, gateway=None,
+                 max_age=3600, max_failures=10):
+        self.fetch_status = fetch_status
+        self.gateway = gateway
+        self.on_change = on_change
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.batch_size = batch_size
+        self.retention = retention
+        self.max_age = max_age
+        self.max_failures = max_failures
+        self.tasks = {}
+        self.condition = threading.Condition()
+        self.thread = None
+
+    def track(self, task_id):
+        """Start tracking a task id (no-op if already tracked)"""
+        with self.condition:
+            if task_id not in self.tasks:
+                now = time.time()
+                self.tasks[task_id] = {
+                    'state': {'success': True, 'status': 'processing'},
+                    'version': 0,
+                    'submitted_at': now,
+                    'updated_at': now,
+                    'next_poll': now + self.min_interval,
+                    'polls': 0,
+                    'failures': 0
+                }
+            self._ensure_thread()
+            self.condition.notify_all()
+
+    def get(self, task_id):
+        """Return the latest known state for a task, or None if untracked"""
+        with self.condition:
+            entry = self.tasks.get(task_id)
+            return dict(entry['state']) if entry else None
+
+    def wait(self, task_id, version, timeout):
+        """Block until the task moves past `version`; return (version, state)"""
+        deadline = time.time() + timeout
+        with self.condition:
+            while True:
+                entry = self.tasks.get(task_id)
+                if entry is None:
+                    return version, None
+                if entry['version'] > version:
+                    return entry['version'], dict(entry['state'])
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return version, dict(entry['state'])
+                self.condition.wait(remaining)
+
+    def _ensure_thread(self):
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name='task-tracker', daemon=True)
+            self.thread.start()
+
+    def _next_interval(self, polls):
+        return min(self.max_interval, self.min_interval * (self.backoff ** polls))
+
+    def _due_tasks(self, now):
+        due = [task_id for task_id, entry in self.tasks.items()
+               if entry['state']['status'] not in TERMINAL_STATUSES and entry['next_poll'] <= now]
+        due.sort(key=lambda task_id: self.tasks[task_id]['next_poll'])
+        return due[:self.batch_size]
+
+    def _prune(self, now):
+        expired = [task_id for task_id, entry in self.tasks.items()
+                   if entry['state']['status'] in TERMINAL_STATUSES
+                   and now - entry['updated_at'] > self.retention]
+        for task_id in expired:
+            del self.tasks[task_id]
+
+    def _sleep_time(self, now):
+        pending = [entry['next_poll'] for entry in self.tasks.values()
+                   if entry['state']['status'] not in TERMINAL_STATUSES]
+        if not pending:
+            return None
+        return max(0.0, min(pending) - now)
+
+    async def _poll_one_async(self, task_id):
+        try:
+            return task_id, await self.fetch_status(task_id)
+        except Exception as e:
+            log_event(logger, logging.WARNING, 'task_poll_failed', task_id=task_id, error=str(e))
+            return task_id, None
+
+    async def _poll_all_async(self, due):
+        return await asyncio.gather(*(self._poll_one_async(task_id) for task_id in due))
+
+    def _run(self):
+        while True:
+            with self.condition:
+                now = time.time()
+                self._prune(now)
+                due = self._due_tasks(now)
+                if not due:
+                    self.condition.wait(self._sleep_time(now))
+                    continue
+
+            results = self.gateway.run(self._poll_all_async(due))
+
+            changed = []
+            with self.condition:
+                now = time.time()
+                for task_id, state in results:
+                    entry = self.tasks.get(task_id)
+                    if entry is None:
+                        continue
+                    entry['polls'] += 1
+                    entry['next_poll'] = now + self._next_interval(entry['polls'])
+                    entry['failures'] = entry['failures'] + 1 if state is None else 0
+                    if state is None or state['status'] not in TERMINAL_STATUSES:
+                        if entry['failures'] >= self.max_failures:
+                            state = {'success': False, 'status': 'failed', 'error': '任务状态查询失败'}
+                        elif now - entry['submitted_at'] > self.max_age:
+                            state = {'success': False, 'status': 'failed', 'error': '等待任务结果超时'}
+                    if state is not None and state != entry['state']:
+                        entry['state'] = state
+                        entry['version'] += 1
+                        entry['updated_at'] = now
+                        changed.append((task_id, dict(state)))
+                        if state['status'] in TERMINAL_STATUSES:
+                            metrics.TASK_COMPLETION.observe(now - entry['submitted_at'], status=state['status'])
+                self.condition.notify_all()
+
+            if self.on_change:
+                for task_id, state in changed:
+                    try:
+                        self.on_change(task_id, state)
+                    except Exception as e:
+                        log_event(logger, logging.ERROR, 'task_callback_failed', task_id=task_id, error=str(e))
@@ -0,0 +1,91 @@
+import hashlib
+import io
+from PIL import Image
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+
+# Streaming multipart parser for image uploads: the body is read in chunks,
+# the image header is sniffed from the first bytes of the file part, and the
+# caller can reject the upload before the rest of the body is received
+
+CHUNK_SIZE = 64 * 1024
+SNIFF_LIMIT = 512 * 1024  # give up identifying the image after this many bytes
+
+class UploadRejected(Exception):
+    """Upload refused before or while its body was received"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class ParsedUpload:
+    """Text fields plus the bytes, digest and header of one uploaded file"""
+
+    def __init__(self):
+        self.fields = {}
+        self.filename = None
+        self.data = bytearray()
+        self.digest = None
+        self.header = None  # (format, width, height) once sniffed
+
+def sniff_image_header(head):
+    """(format, width, height) from the start of an image, or None if not (yet) recognisable"""
+    try:
+        with Image.open(io.BytesIO(head)) as img:
+            return img.format, img.width, img.height
+    except Exception:
+        return None
+
+def parse_upload(stream, content_type, file_field, on_header=None, max_field_bytes=64 * 1024):
+    """Parse a multipart/form-data body chunk by chunk, keeping only `file_field`'s bytes.
+
+    on_header(upload) is called as soon as the image header has been sniffed
+    (upload.filename and upload.header are set) and may raise UploadRejected
+    to stop reading. Other file parts are skipped without being buffered.
+    """
+    mimetype, options = parse_options_header(content_type or '')
+    boundary = options.get('boundary')
+    if mimetype != 'multipart/form-data' or not boundary:
+        raise UploadRejected('请使用 multipart/form-data 上传图像')
+
+    decoder = MultipartDecoder(boundary.encode('latin-1'))
+    upload = ParsedUpload()
+    digest = hashlib.sha256()
+    part = None  # 'file', a field name, or None for parts being skipped
+    field_buffer = bytearray()
+
+    while True:
+        chunk = stream.read(CHUNK_SIZE)
+        decoder.receive_data(chunk or None)
+        event = decoder.next_event()
+        while not isinstance(event, (NeedData, Epilogue)):
+            if isinstance(event, File):
+                part = 'file' if event.name == file_field and upload.filename is None else None
+                if part:
+                    upload.filename = event.filename
+            elif isinstance(event, Field):
+                part = event.name
+                field_buffer = bytearray()
+            elif isinstance(event, Data) and part == 'file':
+                upload.data += event.data
+                digest.update(event.data)
+                if upload.header is None:
+                    upload.header = sniff_image_header(upload.data)
+                    if upload.header is None and upload.data and (len(upload.data) >= SNIFF_LIMIT or not event.more_data):
+                        raise UploadRejected('无法识别的图像格式')
+                    if upload.header is not None and on_header:
+                        on_header(upload)
+            elif isinstance(event, Data) and part is not None:
+                field_buffer += event.data
+                if len(field_buffer) > max_field_bytes:
+                    raise UploadRejected('表单字段过长', 413)
+                if not event.more_data:
+                    upload.fields[part] = field_buffer.decode('utf-8', errors='replace')
+            event = decoder.next_event()
+        if isinstance(event, Epilogue):
+            break
+        if not chunk:
+            raise UploadRejected('上传数据不完整')
+
+    upload.digest = digest.hexdigest()
+    return upload
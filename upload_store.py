@@ -0,0 +1,158 @@
+import hashlib
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from structured_logging import log_event
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed store for uploaded images: identical uploads share one
+# file, and a background sweeper keeps the directory under a disk quota by
+# evicting old or least-recently-used files that no job is still using
+
+class UploadStore:
+    """Files named by SHA-256 with reference counts, an age limit and a disk quota"""
+
+    def __init__(self, directory, url_prefix, max_bytes=512 * 1024 * 1024, max_age=24 * 3600,
+                 sweep_interval=60):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.sweep_interval = sweep_interval
+        self.files = OrderedDict()  # name -> {'size', 'used_at'}, least recently used first
+        self.refs = {}
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.thread = None
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    def put(self, data, ext, acquire=False):
+        """Store bytes under their digest and return the file name; `acquire` also takes a reference"""
+        name = f"{hashlib.sha256(data).hexdigest()}.{ext.lower()}"
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            known = name in self.files
+            if acquire:
+                # Referenced before the write so the sweeper cannot race it
+                self.refs[name] = self.refs.get(name, 0) + 1
+        if not known or not os.path.exists(path):
+            tmp_path = os.path.join(self.directory, f".{uuid.uuid4()}.tmp")
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        with self.lock:
+            self._index(name, len(data), time.time())
+        self._ensure_sweeper()
+        return name
+
+    def acquire(self, name):
+        """Mark a stored file as in use; returns False if it is not in the store"""
+        with self.lock:
+            if name not in self.files:
+                return False
+            self.refs[name] = self.refs.get(name, 0) + 1
+            self._touch(name)
+            return True
+
+    def release(self, name):
+        with self.lock:
+            count = self.refs.get(name, 0) - 1
+            if count > 0:
+                self.refs[name] = count
+            else:
+                self.refs.pop(name, None)
+
+    def path(self, name):
+        """Absolute path of a stored file (refreshing its LRU position), or None"""
+        path = os.path.join(self.directory, name)
+        with self.lock:
+            if name not in self.files:
+                # Possibly written by another worker process since our scan
+                if name.startswith('.') or os.path.basename(name) != name or not os.path.isfile(path):
+                    return None
+                self._index(name, os.path.getsize(path), time.time())
+            self._touch(name)
+        return path
+
+    def local_url(self, name):
+        """URL under which the app serves a stored file"""
+        return f"{self.url_prefix}/{name}"
+
+    def sweep(self):
+        """Evict unreferenced files past max_age, then the least recently used until under quota"""
+        now = time.time()
+        removed = []
+        with self.lock:
+            for name, entry in list(self.files.items()):
+                over_quota = self.total_bytes > self.max_bytes
+                expired = now - entry['used_at'] > self.max_age
+                if not (expired or over_quota):
+                    # Entries are in LRU order, so nothing later is older either
+                    break
+                if self.refs.get(name):
+                    continue
+                self.total_bytes -= entry['size']
+                del self.files[name]
+                removed.append(name)
+        for name in removed:
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+        if removed:
+            log_event(logger, logging.INFO, 'uploads_evicted', files=len(removed), total_bytes=self.total_bytes)
+        return len(removed)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'files': len(self.files),
+                'bytes': self.total_bytes,
+                'max_bytes': self.max_bytes,
+                'in_use': len(self.refs)
+            }
+
+    def _scan(self):
+        # Index what is already on disk (including files from earlier versions) by mtime
+        entries = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.startswith('.') or not os.path.isfile(path):
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for mtime, name, size in sorted(entries):
+            self._index(name, size, mtime)
+
+    def _index(self, name, size, used_at):
+        entry = self.files.get(name)
+        if entry is None:
+            self.files[name] = {'size': size, 'used_at': used_at}
+            self.total_bytes += size
+        else:
+            entry['used_at'] = used_at
+            self.files.move_to_end(name)
+
+    def _touch(self, name):
+        self.files[name]['used_at'] = time.time()
+        self.files.move_to_end(name)
+
+    def _ensure_sweeper(self):
+        with self.lock:
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.thread = threading.Thread(target=self._sweep_forever, name='upload-sweeper', daemon=True)
+            self.thread.start()
+
+    def _sweep_forever(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                log_event(logger, logging.ERROR, 'uploads_sweep_failed', error=str(e))
+            time.sleep(self.sweep_interval)
@@ -0,0 +1,232 @@
+import asyncio
+import atexit
+import os
+import threading
+import time
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from gateway import Gateway, GatewayError
+from circuit_breaker import CircuitBreaker, CircuitOpenError
+from key_pool import KeyPool, NoKeyAvailableError, key_id
+import metrics
+
+# Shared DashScope client: every API call runs on the asyncio gateway, which
+# keeps one keep-alive connection pool for all routes
+
+# Point at a local stand-in (e.g. benchmarks/fake_dashscope.py) for testing
+DASHSCOPE_BASE_URL = os.environ.get('DASHSCOPE_BASE_URL', 'https://dashscope.aliyuncs.com').rstrip('/')
+
+# Pool and retry settings (override via environment)
+MAX_IN_FLIGHT = int(os.environ.get('DASHSCOPE_MAX_IN_FLIGHT', 256))
+POOL_SIZE = int(os.environ.get('DASHSCOPE_POOL_SIZE', 20))
+RETRY_TOTAL = int(os.environ.get('DASHSCOPE_RETRY_TOTAL', 3))
+RETRY_BACKOFF = float(os.environ.get('DASHSCOPE_RETRY_BACKOFF', 0.5))
+# Extra attempts (on another key where possible) after a 429/Throttling response
+THROTTLE_RETRIES = int(os.environ.get('DASHSCOPE_THROTTLE_RETRIES', 2))
+# Circuit breaker: open after this many consecutive failures (timeouts, connection errors, 5xx),
+# or when at least CIRCUIT_FAILURE_RATIO of the calls in the last CIRCUIT_WINDOW seconds failed
+CIRCUIT_FAILURES = int(os.environ.get('DASHSCOPE_CIRCUIT_FAILURES', 5))
+CIRCUIT_FAILURE_RATIO = float(os.environ.get('DASHSCOPE_CIRCUIT_FAILURE_RATIO', 0.5))
+CIRCUIT_WINDOW = float(os.environ.get('DASHSCOPE_CIRCUIT_WINDOW', 30))
+CIRCUIT_MIN_CALLS = int(os.environ.get('DASHSCOPE_CIRCUIT_MIN_CALLS', 10))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get('DASHSCOPE_CIRCUIT_OPEN_SECONDS', 30))
+
+# Upstream endpoints: path and (connect, read) timeout in seconds
+ENDPOINTS = {
+    'image-synthesis': ('/api/v1/services/aigc/text2image/image-synthesis', (5, 30)),
+    'task': ('/api/v1/tasks/{task_id}', (5, 10)),
+    'multimodal-generation': ('/api/v1/services/aigc/multimodal-generation/generation', (5, 60)),
+}
+
+# Long-running calls that draw from each key's separate edit slot budget
+EDIT_ENDPOINTS = ('multimodal-generation',)
+
+def create_session():
+    """Create a pooled blocking session (used for downloading result images)"""
+    retry = Retry(
+        total=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=frozenset(['GET']),
+        raise_on_status=False
+    )
+    adapter = HTTPAdapter(
+        pool_connections=1,
+        pool_maxsize=POOL_SIZE,
+        pool_block=True,
+        max_retries=retry
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+session = create_session()
+gateway = Gateway(max_connections=MAX_IN_FLIGHT)
+atexit.register(gateway.close)
+
+def endpoint_url(endpoint, **path_params):
+    """Build the full URL and timeout for a named endpoint"""
+    path, timeout = ENDPOINTS[endpoint]
+    return DASHSCOPE_BASE_URL + path.format(**path_params), timeout
+
+# One breaker per endpoint: edits can degrade while task queries still work
+circuit_breakers = {endpoint: CircuitBreaker(
+    endpoint,
+    consecutive_failures=CIRCUIT_FAILURES,
+    failure_ratio=CIRCUIT_FAILURE_RATIO,
+    window=CIRCUIT_WINDOW,
+    min_calls=CIRCUIT_MIN_CALLS,
+    open_seconds=CIRCUIT_OPEN_SECONDS
+) for endpoint in ENDPOINTS}
+
+def circuit_retry_after(endpoint):
+    """Seconds until calls to an endpoint are admitted again, or None if they are now"""
+    return circuit_breakers[endpoint].retry_after()
+
+def circuit_stats():
+    return {endpoint: breaker.stats() for endpoint, breaker in circuit_breakers.items()}
+
+# API keys used for every call; replaced by configure_keys() at startup
+key_pool = KeyPool([])
+
+# Task id -> key that submitted it, so task queries go to the owning account
+task_owners = OrderedDict()
+task_owners_lock = threading.Lock()
+
+def task_owner_id(task_id):
+    """key_id() of the key that submitted a task, or None if unknown"""
+    with task_owners_lock:
+        key = task_owners.get(task_id)
+    return key_id(key) if key else None
+
+def restore_task_owner(task_id, owner_id):
+    """Send queries for a resumed task to the key that submitted it; False if that key is gone"""
+    for api_key in key_pool.keys:
+        if key_id(api_key.key) == owner_id:
+            with task_owners_lock:
+                task_owners[task_id] = api_key.key
+            return True
+    return False
+
+def configure_keys(pool):
+    """Install the key pool used to authorize upstream calls"""
+    global key_pool
+    key_pool = pool
+
+def is_throttled(response):
+    """True for 429s and DashScope Throttling error codes"""
+    if response.status_code == 429:
+        return True
+    return response.status_code >= 400 and 'Throttling' in response.text[:500]
+
+def retry_after(response):
+    try:
+        return float(response.headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+def remember_task_owner(response, api_key):
+    try:
+        task_id = response.json().get('output', {}).get('task_id')
+    except ValueError:
+        return
+    if task_id:
+        with task_owners_lock:
+            task_owners[task_id] = api_key.key
+            while len(task_owners) > 10000:
+                task_owners.popitem(last=False)
+
+async def acquire_key(preferred=None, timeout=30.0, edit=False):
+    """Reserve a key from the pool without blocking the event loop"""
+    deadline = time.monotonic() + timeout
+    while True:
+        api_key, delay = key_pool.try_acquire(preferred, edit)
+        if api_key is not None:
+            return api_key
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise NoKeyAvailableError('API请求繁忙，请稍后重试', delay)
+        # Releases are not signalled to the loop, so re-check at least every 100ms
+        await asyncio.sleep(min(remaining, delay, 0.1))
+
+async def send_async(method, endpoint, headers, payload=None, **path_params):
+    """Send a request with a key from the pool, moving to another key when throttled.
+
+    GETs are also retried with exponential backoff on connection errors and 5xx.
+    Raises CircuitOpenError at once while the endpoint's circuit is open, and
+    NoKeyAvailableError when no key frees up in time.
+    """
+    url, timeout = endpoint_url(endpoint, **path_params)
+    breaker = circuit_breakers[endpoint]
+    edit = endpoint in EDIT_ENDPOINTS
+    with task_owners_lock:
+        preferred = task_owners.get(path_params.get('task_id'))
+
+    throttles = errors = 0
+    while True:
+        try:
+            breaker.before_request()
+        except CircuitOpenError:
+            metrics.UPSTREAM_RESPONSES.inc(endpoint=endpoint, status='CircuitOpenError')
+            raise
+        try:
+            api_key = await acquire_key(preferred, edit=edit)
+        except BaseException:
+            breaker.record(None)
+            raise
+        response = None
+        failed = None
+        started = time.perf_counter()
+        try:
+            response = await gateway.request(
+                method,
+                url,
+                headers={**headers, 'Authorization': f'Bearer {api_key.key}'},
+                payload=payload,
+                timeout=timeout
+            )
+        except GatewayError as e:
+            failed = True
+            metrics.UPSTREAM_RESPONSES.inc(endpoint=endpoint, status=type(e).__name__)
+            if method != 'GET' or errors >= RETRY_TOTAL:
+                raise
+        finally:
+            if response is not None:
+                failed = response.status_code >= 500
+            breaker.record(failed)
+            metrics.UPSTREAM_LATENCY.observe(time.perf_counter() - started, endpoint=endpoint)
+            throttled = response is not None and is_throttled(response)
+            key_pool.release(api_key, throttled, retry_after(response) if throttled else None, edit)
+
+        if response is not None:
+            metrics.UPSTREAM_RESPONSES.inc(endpoint=endpoint, status=response.status_code)
+            if throttled and throttles < THROTTLE_RETRIES:
+                throttles += 1
+                continue
+            if not (method == 'GET' and response.status_code >= 500 and errors < RETRY_TOTAL):
+                break
+        errors += 1
+        await asyncio.sleep(RETRY_BACKOFF * (2 ** (errors - 1)))
+
+    if endpoint == 'image-synthesis' and response.status_code == 200:
+        remember_task_owner(response, api_key)
+    return response
+
+async def post_async(endpoint, headers, payload):
+    """POST a JSON payload to a DashScope endpoint (only retried when throttled)"""
+    return await send_async('POST', endpoint, headers, payload)
+
+async def get_async(endpoint, headers, **path_params):
+    """GET a DashScope endpoint, retrying on connection errors, 5xx and throttling"""
+    return await send_async('GET', endpoint, headers, **path_params)
+
+def post(endpoint, headers, payload):
+    """Blocking post_async() for code running on ordinary threads"""
+    return gateway.run(post_async(endpoint, headers, payload))
+
+def get(endpoint, headers, **path_params):
+    """Blocking get_async() for code running on ordinary threads"""
+    return gateway.run(get_async(endpoint, headers, **path_params))